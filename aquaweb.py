@@ -17,13 +17,34 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import array
 import base64
+import bisect
+import collections
+import concurrent.futures
+import ctypes
+import ctypes.util
+import gzip
+import hashlib
+import json
+import math
+import mimetypes
+import mmap
+import multiprocessing
+from multiprocessing import shared_memory
+import pickle
+import re
+import select
+import selectors
+import signal
 import string
 import threading
 import sys
 import time
 import os
 import socket
+import socketserver
+import struct
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import urllib
 import serial
@@ -34,7 +55,9 @@ import time
 RS485Device = "/dev/ttyUSB0"        # RS485 serial device to be used
 debugData = False
 debugRaw = False
-lastReadMsgTime = time.time()
+lastReadMsgTime = time.monotonic()
+ackGuard = 0.004                    # Nominal delay between a read and our reply
+startTime = time.monotonic()        # For the time-to-first-ACK/HTTP startup log
 
 # ASCII constants
 NUL = 0x00
@@ -55,22 +78,89 @@ if (window.XMLHttpRequest) {
     var xmlHttpReqScreen = new ActiveXObject("Microsoft.XMLHTTP");
 }
 
+var ws = null;
+
+function start() { /* Prefer pushed updates, poll if the upgrade fails */
+    var opened = false;
+    try {
+        ws = new WebSocket((location.protocol == "https:" ? "wss://" : "ws://") + location.host + location.pathname.replace(/[^\/]*$/, "") + "ws");
+    } catch (e) {
+        ws = null;
+        screen();
+        return;
+    }
+    ws.onopen = function() { opened = true; }
+    ws.onmessage = function(e) {
+        var m = JSON.parse(e.data);
+        if (m.screenpatch != undefined) {
+            patchscreen(m.screenpatch);
+        }
+    }
+    ws.onclose = function() {
+        ws = null;
+        if (opened) {
+            setTimeout(start, 1000);
+        } else {
+            screen();
+        }
+    }
+}
+
+var version = "";
+var lines = [];
+
+function patchscreen(m) { /* Apply changed lines, or a full screen */
+    if (m.full) {
+        lines = [];
+    }
+    for (var x in m.lines) {
+        lines[x] = m.lines[x];
+    }
+    version = m.version;
+    document.getElementById("screen").innerHTML = "<pre>" + lines.join("\n") + "\n</pre>";
+}
+
 function screen() {
-    xmlhttpPost(xmlHttpReqScreen, "/cgi/screen.cgi", "", "screen");
+    var xmlReq = xmlHttpReqScreen;
+    xmlReq.open('POST', "cgi/screen.cgi", true);
+    xmlReq.setRequestHeader("Content-type","application/x-www-form-urlencoded");
+    xmlReq.onreadystatechange = function() {
+        if (xmlReq.readyState == 4) {
+            if (xmlReq.status == 200) {
+                patchscreen(JSON.parse(xmlReq.responseText));
+            }
+            setTimeout(screen, 250);
+        }
+    }
+    xmlReq.send("since=" + version);
 }
 
 function sendkey(key) {
-    xmlhttpPost(xmlHttpReqKey, "/cgi/key.cgi", "key="+key);
+    if (ws && (ws.readyState == 1)) {
+        ws.send(JSON.stringify({key: key}));
+    } else {
+        xmlhttpPost(xmlHttpReqKey, "cgi/key.cgi", "key="+key);
+    }
 }
 
+var etags = {};
+
 function xmlhttpPost(xmlReq, strURL, params, update) {
     xmlReq.open('POST', strURL, true);
     xmlReq.setRequestHeader("Content-type","application/x-www-form-urlencoded");
+    if (etags[strURL]) {
+        xmlReq.setRequestHeader("If-None-Match", etags[strURL]);
+    }
     xmlReq.send(params);
     if (update != "") {
       xmlReq.onreadystatechange = function() {
         if (xmlReq.readyState == 4) {
-            updatepage(xmlReq.responseText, update);
+            if (xmlReq.status == 304) { /* Unchanged, just ask again */
+                setTimeout(window[update], 250);
+            } else {
+                etags[strURL] = xmlReq.getResponseHeader("ETag");
+                updatepage(xmlReq.responseText, update);
+            }
         }
       }
     }
@@ -92,7 +182,7 @@ VwAA+qYAAPfRAAD/ywAA/98AAP//AAD//wAA""")
 
 SQUAREHTML = "<html><head><title>Pool Controller</title>" + JAVASCRIPT + """
 </head>
-<body onload="screen();">
+<body onload="start();">
 <table>
 <tr>
 <td>
@@ -114,7 +204,7 @@ SQUAREHTML = "<html><head><title>Pool Controller</title>" + JAVASCRIPT + """
 
 PDAHTML = "<html><head><title>Pool Controller</title>" + JAVASCRIPT + """
 </head>
-<body onload="screen();">
+<body onload="start();">
 <table>
 <tr><td style="border:1px solid black;"><font size="+2"><div id="screen"></div></font></td></tr>
 <tr><td>
@@ -147,26 +237,73 @@ if (window.XMLHttpRequest) {
     var xmlHttpReqStatus = new ActiveXObject("Microsoft.XMLHTTP");
 }
 
+var ws = null;
+
+function start() { /* Prefer pushed updates, poll if the upgrade fails */
+    var opened = false;
+    try {
+        ws = new WebSocket((location.protocol == "https:" ? "wss://" : "ws://") + location.host + location.pathname.replace(/[^\/]*$/, "") + "ws");
+    } catch (e) {
+        ws = null;
+        cstat();
+        screen();
+        return;
+    }
+    ws.onopen = function() { opened = true; }
+    ws.onmessage = function(e) {
+        var m = JSON.parse(e.data);
+        if (m.spascreen != undefined) {
+            document.getElementById("screen").innerHTML = m.spascreen;
+        }
+        if (m.spastatus != undefined) {
+            document.getElementById("cstat").innerHTML = m.spastatus;
+        }
+    }
+    ws.onclose = function() {
+        ws = null;
+        if (opened) {
+            setTimeout(start, 1000);
+        } else {
+            cstat();
+            screen();
+        }
+    }
+}
+
 function screen() { /* Ping-pong between lights and lcd */
-    xmlhttpPost(xmlHttpReqStatus, "/cgi/spastatus.cgi", "", "cstat");
+    xmlhttpPost(xmlHttpReqStatus, "cgi/spastatus.cgi", "", "cstat");
 }
 
 function cstat() {
-    xmlhttpPost(xmlHttpReqScreen, "/cgi/spascreen.cgi", "", "screen");
+    xmlhttpPost(xmlHttpReqScreen, "cgi/spascreen.cgi", "", "screen");
 }
 
 function sendkey(key) {
-    xmlhttpPost(xmlHttpReqKey, "/cgi/spakey.cgi", "key="+key);
+    if (ws && (ws.readyState == 1)) {
+        ws.send(JSON.stringify({spakey: key}));
+    } else {
+        xmlhttpPost(xmlHttpReqKey, "cgi/spakey.cgi", "key="+key);
+    }
 }
 
+var etags = {};
+
 function xmlhttpPost(xmlReq, strURL, params, update) {
     xmlReq.open('POST', strURL, true);
     xmlReq.setRequestHeader("Content-type","application/x-www-form-urlencoded");
+    if (etags[strURL]) {
+        xmlReq.setRequestHeader("If-None-Match", etags[strURL]);
+    }
     xmlReq.send(params);
     if (update != "") {
       xmlReq.onreadystatechange = function() {
         if (xmlReq.readyState == 4) {
-            updatepage(xmlReq.responseText, update);
+            if (xmlReq.status == 304) { /* Unchanged, just ask again */
+                setTimeout(window[update], 250);
+            } else {
+                etags[strURL] = xmlReq.getResponseHeader("ETag");
+                updatepage(xmlReq.responseText, update);
+            }
         }
       }
     }
@@ -180,7 +317,7 @@ function updatepage(str, div){
 
 </script>
 </head>
-<body onload="cstat(); screen();">
+<body onload="start();">
 <table>
 <tr>
 <td><div id="screen"></div></td>
@@ -211,49 +348,695 @@ function updatepage(str, div){
 """
 
 PORT = 80
+HTTPWORKERS = 16                    # Concurrent HTTP connections served
+HTTPIDLE = 30                       # Seconds before an idle keep-alive is closed
+WEBSOCKETS = 32                     # Open WebSockets, each on its own thread outside the pool
+ASSETDIR = None                     # Optional directory of files served ahead of the built-ins
+KEYQUEUE = 32                       # Keypresses a device holds waiting for the controller
+HISTORYTIERS = ((1, 3600),          # (Seconds per bucket, buckets): an hour by the second,
+                (60, 1440),         # a day by the minute,
+                (3600, 2160))       # and 90 days by the hour
+HISTORYSERIES = 64                  # Most history series kept, about 230 KB each
+EVENTBLOCK = 65536                  # Buffered event bytes that force a write
+EVENTFLUSH = 60                     # Seconds buffered events wait at most
+EVENTSYNC = 300                     # Minimum seconds between fsyncs
+EVENTSEGMENT = 4 * 1024 * 1024      # Event log segment size before rotating
+EVENTSEGMENTS = 16                  # Segments kept
+TRACESIZE = 1024                    # Frames kept by the flight recorder
+NAVTIMEOUT = 30                     # Longest (and default) seconds a menu walk may take
+RECONNECTMIN = 0.1                  # First wait before retrying a lost serial port
+RECONNECTMAX = 10.0                 # Longest wait between retries
+SPLITSLOT = 65536                   # Shared memory for each device's state with --split
+SPLITREPORT = 1.0                   # Seconds between the bus process's statistics reports
+SPLITPRIORITY = 10                  # SCHED_FIFO priority of the bus process with --realtime
+DETECTCACHE = "/var/tmp/aquaweb.detected"  # Last auto-detected device IDs
+DETECTTIME = 15                     # Longest auto-detection will listen
+DETECTQUIET = 2.0                   # Seconds without a new address that ends detection
+
+
+class StaticAsset:
+    """A built-in file, encoded and gzipped once with strong ETags for both."""
+
+    def __init__(self, body, mimetype, cache):
+        if isinstance(body, str):
+            body = body.encode("UTF-8")
+        self.mimetype = mimetype
+        self.cache = cache
+        digest = hashlib.sha1(body).hexdigest()[:16]
+        self.plain = (body, '"%s"' % digest)
+        self.gzip = (gzip.compress(body, 9, mtime=0), '"%s-gz"' % digest)
+
+
+def buildAssets():
+    """Encode and compress the built-in pages, once the emulators have
+    decided which remote's page is the index."""
+    return {'/index.html': StaticAsset(INDEXHTML, 'text/html', 'no-cache'),
+            '/square.html': StaticAsset(SQUAREHTML, 'text/html', 'no-cache'),
+            '/pda.html': StaticAsset(PDAHTML, 'text/html', 'no-cache'),
+            '/spa.html': StaticAsset(SPAHTML, 'text/html', 'no-cache'),
+            '/favicon.ico': StaticAsset(FAVICON, 'image/vnd.microsoft.icon',
+                                        'public, max-age=86400')}
+
+
+class Notifier:
+    """Sequence counter bumped whenever emulated state changes, so web
+    clients can sleep until there is actually something new to send."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.seq = 0
+
+    def bump(self):
+        """State changed, wake up anyone waiting."""
+        with self.cond:
+            self.seq += 1
+            self.cond.notify_all()
+
+    def wait(self, seen, timeout):
+        """Wait until the sequence moves past seen, return the new value."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq != seen, timeout)
+            return self.seq
+
+updates = Notifier()
+
+
+class HistorySeries:
+    """One recorded value in a fixed ring of buckets per tier.  A bucket
+    keeps the min, max and last value seen in its time slot, and its slot
+    is found by arithmetic on the time, so recording and lookups never
+    scan and memory is fixed when the series is created."""
+
+    def __init__(self, tiers):
+        self.tiers = []
+        for res, slots in tiers:
+            self.tiers.append((res, slots, array.array('q', [-1]) * slots,
+                               array.array('d', [0.0]) * slots,
+                               array.array('d', [0.0]) * slots,
+                               array.array('d', [0.0]) * slots))
+        self.last = None
+
+    def record(self, value, now):
+        """Fold a value seen at now (epoch seconds) into every tier."""
+        self.last = value
+        for res, slots, stamp, low, high, last in self.tiers:
+            bucket = int(now // res)
+            slot = bucket % slots
+            if stamp[slot] != bucket:  # Reuse the slot, invalid while it's rewritten
+                stamp[slot] = -1
+                low[slot] = high[slot] = last[slot] = value
+                stamp[slot] = bucket
+                continue
+            if value < low[slot]:
+                low[slot] = value
+            elif value > high[slot]:
+                high[slot] = value
+            last[slot] = value
+
+    def query(self, start, end, res=None):
+        """(resolution, [[time, min, max, last], ...]) of the buckets with
+        values between start and end, from the finest tier still holding
+        start, or the tier with the given resolution."""
+        now = time.time()
+        for tier in self.tiers:
+            if (tier[0] == res) or ((res is None) and (now - start < tier[0] * tier[1])):
+                break
+        res, slots, stamp, low, high, last = tier
+        first = int(start // res)
+        final = int(end // res)
+        first = max(first, final - slots + 1)
+        points = []
+        for bucket in range(first, final + 1):
+            slot = bucket % slots
+            if stamp[slot] == bucket:
+                point = [bucket * res, low[slot], high[slot], last[slot]]
+                if stamp[slot] == bucket:  # Not overwritten while we read it
+                    points.append(point)
+        return res, points
+
+
+class History:
+    """Named HistorySeries, e.g. "20.heat" or "40.temp.air", created the
+    first time something is recorded under the name.  Equipment names come
+    from whatever the remote's menus show, so at most limit series are
+    made and later names are only counted, keeping memory flat."""
+
+    def __init__(self, tiers=HISTORYTIERS, limit=HISTORYSERIES):
+        self.tiers = tiers
+        self.limit = limit
+        self.series = {}
+        self.refused = 0  # Values dropped for want of a series
+
+    def record(self, name, value, now=None):
+        """Remember value for name, if it differs from the last one recorded."""
+        series = self.series.get(name)
+        if series is None:
+            if len(self.series) >= self.limit:
+                if not self.refused:
+                    log("History", "series limit %d reached, not recording %s or any other "
+                                   "new name" % (self.limit, name))
+                self.refused += 1
+                return
+            series = HistorySeries(self.tiers)
+            self.series[name] = series
+        elif series.last == value:
+            return
+        series.record(value, time.time() if now is None else now)
+
+    def query(self, name, start, end, res=None):
+        """Dict of the points for a range, or None for an unknown name."""
+        series = self.series.get(name)
+        if series is None:
+            return None
+        res, points = series.query(start, end, res)
+        return {'series': name, 'resolution': res, 'points': points}
+
+history = History()
+
+
+class WebSocket:
+    """Minimal RFC 6455 server side framing over an upgraded HTTP connection."""
+    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+    MAXFRAME = 65536  # Largest payload taken from a client, keypresses are tiny
+
+    def __init__(self, handler):
+        self.rfile = handler.rfile
+        self.conn = handler.connection
+        self.sendLock = threading.Lock()
+        self.closed = False
+
+    @classmethod
+    def accept(cls, key):
+        """Sec-WebSocket-Accept value for a client's Sec-WebSocket-Key."""
+        digest = hashlib.sha1((key + cls.GUID).encode("ascii")).digest()
+        return base64.b64encode(digest).decode("ascii")
+
+    def send(self, payload, opcode=0x1):
+        """Send one unmasked frame, text by default."""
+        if isinstance(payload, str):
+            payload = payload.encode("UTF-8")
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        with self.sendLock:
+            self.conn.sendall(header + payload)
+
+    def close(self, code):
+        """Send a close frame with a status code and stop reading."""
+        try:
+            self.send(struct.pack("!H", code), 0x8)
+        except OSError:
+            pass
+        self.closed = True
+
+    def _read(self, size):
+        data = self.rfile.read(size)
+        if len(data) < size:
+            raise EOFError
+        return data
+
+    def recv(self):
+        """Return the next text message, answering pings along the way.
+        Returns None once the client closes the connection."""
+        while True:
+            try:
+                b0, b1 = self._read(2)
+                length = b1 & 0x7f
+                if length == 126:
+                    length = struct.unpack("!H", self._read(2))[0]
+                elif length == 127:
+                    length = struct.unpack("!Q", self._read(8))[0]
+                if length > self.MAXFRAME:
+                    self.close(1009)  # Message too big
+                    return None
+                mask = self._read(4) if b1 & 0x80 else b"\x00\x00\x00\x00"
+                payload = bytearray(self._read(length))
+            except (EOFError, OSError, ValueError):
+                self.closed = True
+                return None
+            for x in range(length):
+                payload[x] ^= mask[x & 3]
+            opcode = b0 & 0x0f
+            if opcode == 0x8:  # Close
+                try:
+                    self.send(b"", 0x8)
+                except OSError:
+                    pass
+                self.closed = True
+                return None
+            elif opcode == 0x9:  # Ping
+                self.send(bytes(payload), 0xa)
+            elif opcode == 0x1:  # Text
+                return payload.decode("UTF-8", "replace")
 
 
 class webHandler(BaseHTTPRequestHandler):
     """CGI and dummy web page handler to interface to control objects."""
+    protocol_version = "HTTP/1.1"  # Keep-alive, so every reply needs a Content-Length
+    timeout = HTTPIDLE
+    wbufsize = -1                  # Headers and body leave in one send
     screen = None
     spa = None
+    interface = None
+    link = None                    # BusLink to the bus process with --split
+    devices = {}
+    navigator = None
+    navigators = {}
+    page = '/index.html'
+    assets = {}
+    stateCache = (None, None)
     path = None
+    firstResponse = True
+    requestStart = None
+    upgraded = None                # WebSocket to hand off once the request is done
+    parked = False                 # Hand the connection to the idle watcher once done
+    timings = {}                   # Path to Histogram of request handling time
+    timingLock = threading.Lock()
+    MAXTIMINGS = 64                # Distinct paths timed before the rest go to "other"
+    POSTONLY = ("/cgi/key.cgi", "/cgi/keys.cgi", "/cgi/spakey.cgi", "/cgi/spakeys.cgi",
+                "/api/navigate")   # They press keys, so a prefetch or <img> mustn't reach them
 
     def log_request(self, code='-', size='-'):
-        """Don't log anything, we're on an embedded system"""
+        """Don't log anything, we're on an embedded system, bar the first
+        reply so restarts show how long the web UI was down."""
+        if webHandler.firstResponse:
+            webHandler.firstResponse = False
+            log("HTTP", "first response %.3f s after start" % (time.monotonic() - startTime))
+
+    def parse_request(self):
+        """The request line is in, start the clock on this request."""
+        self.requestStart = time.perf_counter()
+        return BaseHTTPRequestHandler.parse_request(self)
+
+    def handle(self):
+        """Serve requests while they keep coming, then flag the connection
+        to go to the server's idle watcher rather than hold a worker waiting
+        for the next one.  Also carries on a parked connection that woke up."""
+        self.parked = False
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self.waiting():
+                self.parked = True  # The server parks it once this worker is done
+                return
+            self.handle_one_request()
+
+    def startWebsocket(self):
+        """Run an upgraded connection on its own threads."""
+        threading.Thread(target=self.websocketKeys, args=(self.upgraded,), daemon=True).start()
+        threading.Thread(target=self.websocketPush, args=(self.upgraded,), daemon=True).start()
+
+    def waiting(self):
+        """True if more of the next request is already buffered or readable."""
+        self.connection.settimeout(0)
+        try:
+            return len(self.rfile.peek(1)) > 0
+        except OSError:
+            return True  # Let handle_one_request see the error
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def finish(self):
+        """Flush and close, unless the connection was parked or handed to a
+        WebSocket thread, which then owns it."""
+        if not self.parked and (self.upgraded is None):
+            BaseHTTPRequestHandler.finish(self)
+
+    def handle_one_request(self):
+        """Serve one request, then add its time to the path's histogram."""
+        self.requestStart = None
+        BaseHTTPRequestHandler.handle_one_request(self)
+        if (self.requestStart is None) or (self.path is None):
+            return
+        took = time.perf_counter() - self.requestStart
+        path = urllib.parse.urlsplit(self.path).path.replace('"', '').replace('\\', '')
+        if path == "/ws":
+            return  # Lives as long as the page is open
+        hist = self.timings.get(path)
+        if hist is None:
+            with self.timingLock:
+                if (len(self.timings) >= self.MAXTIMINGS) or not (
+                        path.startswith(("/cgi/", "/api/")) or path in self.assets):
+                    path = "other"
+                hist = self.timings.setdefault(path, Histogram(HTTPBUCKETS, lock=True))
+        hist.observe(took)
 
     def log_error(self, fmt, *args):
         """This was an error, dump it."""
         self.log_message(fmt, *args)
 
+    def sendBody(self, body, mimetype, etag=None):
+        """Send a complete 200 reply with its Content-Length."""
+        if isinstance(body, str):
+            body = body.encode("UTF-8")
+        self.send_response(200)
+        self.send_header('Content-Type', mimetype)
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except:
+            pass
+
+    def notModified(self, etag, cache='no-cache'):
+        """Send a 304 and return True if the client already has etag."""
+        match = self.headers.get('If-None-Match', '')
+        if etag not in [tag.strip() for tag in match.split(",")]:
+            return False
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', cache)
+        self.end_headers()
+        return True
+
+    def sendVersion(self, version, mimetype):
+        """Send an (etag, body) pair, or 304 if the client already has it."""
+        etag, body = version
+        if not self.notModified(etag):
+            self.sendBody(body, mimetype, etag)
+
+    def sendAsset(self, asset):
+        """Send a prebuilt static asset, gzipped if the client takes it."""
+        useGzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        body, etag = asset.gzip if useGzip else asset.plain
+        if self.notModified(etag, asset.cache):
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', asset.mimetype)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', asset.cache)
+        self.send_header('Vary', 'Accept-Encoding')
+        if useGzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except:
+            pass
+
+    def sendFile(self):
+        """Serve a file from ASSETDIR with sendfile, returning False if there
+        is no such file."""
+        if ASSETDIR is None:
+            return False
+        rel = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip("/")
+        root = os.path.realpath(ASSETDIR)
+        name = os.path.realpath(os.path.join(root, rel))
+        if (not name.startswith(root + os.sep)) or (not os.path.isfile(name)):
+            return False
+        with open(name, "rb") as f:
+            st = os.fstat(f.fileno())
+            etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+            if self.notModified(etag):
+                return True
+            self.send_response(200)
+            self.send_header('Content-Type', mimetypes.guess_type(name)[0] or 'application/octet-stream')
+            self.send_header('Content-Length', str(st.st_size))
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            try:
+                self.wfile.flush()
+                self.connection.sendfile(f)  # os.sendfile, no copy through Python
+            except OSError:
+                self.close_connection = True
+        return True
+
+    def route(self):
+        """Point this request at the device a /dev/<id>/ path names and strip
+        the prefix, so every page and CGI works per device.  Returns False
+        if a reply has already been sent."""
+        if not self.path.startswith("/dev/"):
+            return True
+        devId, slash, rest = self.path[5:].partition("/")
+        try:
+            dev = self.devices.get(int(devId, 16))
+        except ValueError:
+            dev = None
+        if dev is None:
+            self.send_error(404, 'No such device: %s' % self.path)
+            return False
+        if not slash:  # Relative URLs in the page need the trailing slash
+            self.send_response(301)
+            self.send_header('Location', self.path + "/")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return False
+        if isinstance(dev, Spa):
+            self.screen = None
+            self.spa = dev
+        else:
+            self.screen = dev
+            self.spa = None
+            self.navigator = self.navigators.get(dev.ID)
+        self.page = dev.PAGE
+        self.path = "/" + rest
+        return True
+
     #Handler for the GET requests
     def do_GET(self):
         """HTTP GET handler, only the html files allowed."""
+        if not self.route():
+            return
         if self.path == "/":
             self.path = "/index.html"
-        if (self.path == "/favicon.ico") or (self.path == "favicon.ico"):
-            self.send_response(200)
-            self.send_header('Content-Type', "image/vnd.microsoft.icon")
+        if (self.path == "/ws") and (self.headers.get('Upgrade', '').lower() == "websocket"):
+            self.websocket()
+        elif self.path.startswith(self.POSTONLY):
+            self.send_response(405)
+            self.send_header('Allow', 'POST')
+            self.send_header('Content-Length', '0')
             self.end_headers()
-            self.wfile.write(FAVICON)
+        elif self.path.startswith("/cgi/"):
+            query = urllib.parse.urlsplit(self.path).query
+            self.cgi(urllib.parse.parse_qs(query, keep_blank_values=1))
+        elif self.path.startswith("/api/"):
+            query = urllib.parse.urlsplit(self.path).query
+            self.api(urllib.parse.parse_qs(query, keep_blank_values=1))
+        elif self.path == "/metrics":
+            self.sendBody(self.metrics(), 'text/plain; version=0.0.4')
+        elif self.sendFile():
+            pass
+        elif (self.path == "/favicon.ico") or (self.path == "favicon.ico"):
+            self.sendAsset(self.assets['/favicon.ico'])
         # We only serve some static stuff
-        elif (self.path.startswith("/spa") or self.path.startswith("/index.html")):
-            mimetype = 'text/html'
-            ret = ""
-            if self.path.startswith("/index.html"):
-                ret = INDEXHTML
-            elif self.path.startswith("/spa"):
-                ret = SPAHTML
-            self.send_response(200)
-            self.send_header('Content-Type', mimetype)
-            self.end_headers()
+        elif self.path.startswith("/index.html"):
+            self.sendAsset(self.assets[self.page])
+        elif self.path.startswith("/spa"):
+            self.sendAsset(self.assets['/spa.html'])
+        else:
+            self.send_error(404, 'File Not Found: %s' % self.path)
+
+    def metrics(self):
+        """Counters and histograms in the Prometheus text format."""
+        out = []
+
+        def metric(name, kind, helptext, lines):
+            out.append("# HELP %s %s" % (name, helptext))
+            out.append("# TYPE %s %s" % (name, kind))
+            out.extend(lines)
+
+        i = self.interface
+        bus = i.busStats.stats()
+        metric("aquaweb_uptime_seconds", "gauge", "Seconds since start.",
+               ["aquaweb_uptime_seconds %.1f" % (time.monotonic() - startTime)])
+        metric("aquaweb_frames_total", "counter", "Frames decoded, by destination and command.",
+               ['aquaweb_frames_total{dest="%s",cmd="%s"} %d' % (dest, cmd, count)
+                for dest, dev in sorted(bus['devices'].items())
+                for cmd, count in sorted(dev['cmds'].items())])
+        metric("aquaweb_bad_frames_total", "counter", "Frames with a bad checksum or framing.",
+               ["aquaweb_bad_frames_total %d" % bus['badFrames']])
+        metric("aquaweb_bus_bytes_total", "counter", "Bytes read from the bus.",
+               ["aquaweb_bus_bytes_total %d" % bus['bytes']])
+        metric("aquaweb_serial_reopens_total", "counter", "Times the serial port was reopened.",
+               ["aquaweb_serial_reopens_total %d" % i.reopens])
+        metric("aquaweb_serial_outage_seconds_total", "counter",
+               "Time spent without the serial port, including an outage still going on.",
+               ["aquaweb_serial_outage_seconds_total %.1f" % i.outageTime()])
+        acks = sorted(i.watchdog.devices.copy().items())
+        metric("aquaweb_acks_total", "counter", "ACKs sent, by device.",
+               ['aquaweb_acks_total{dev="%s"} %d' % (toHex(dest), dev['acks']) for dest, dev in acks])
+        metric("aquaweb_ack_missed_total", "counter", "ACKs the master resent the frame for.",
+               ['aquaweb_ack_missed_total{dev="%s"} %d' % (toHex(dest), dev['missed'])
+                for dest, dev in acks])
+        metric("aquaweb_ack_guard_seconds", "gauge", "Current turnaround guard.",
+               ["aquaweb_ack_guard_seconds %.6f" % i.watchdog.guard])
+        metric("aquaweb_read_to_ack_seconds", "histogram", "Time from reading a frame to our ACK.",
+               [line for dest, dev in acks
+                for line in dev['histogram'].lines("aquaweb_read_to_ack_seconds",
+                                                   'dev="%s"' % toHex(dest))])
+        devices = sorted(self.devices.items())
+        metric("aquaweb_process_seconds", "histogram",
+               "Bus thread time spent updating device state after each ACK.",
+               [line for devId, dev in devices
+                for line in dev.processTime.lines("aquaweb_process_seconds",
+                                                  'dev="%s"' % toHex(devId))])
+        metric("aquaweb_key_queue_depth", "gauge", "Keypresses waiting for the controller.",
+               ['aquaweb_key_queue_depth{dev="%s"} %d' % (toHex(devId), dev.keys.depth())
+                for devId, dev in devices])
+        metric("aquaweb_http_request_seconds", "histogram", "HTTP request handling time by path.",
+               [line for path, hist in sorted(self.timings.copy().items())
+                for line in hist.lines("aquaweb_http_request_seconds", 'path="%s"' % path)])
+        return "\n".join(out) + "\n"
+
+    def pushState(self, sent):
+        """Current state of the emulated devices as a JSON message, or None
+        if nothing differs from what this client was last sent."""
+        state = {}
+        if self.screen is not None:
+            patch = self.screen.delta(sent.get('version'))
+            if patch['version'] != sent.get('version'):
+                sent['version'] = patch['version']
+                state['screenpatch'] = patch
+        if self.spa is not None:
+            state['spascreen'] = self.spa.html()
+            state['spastatus'] = self.spa.statusVersion()[1]
+        changed = {k: v for k, v in state.items() if (k == 'screenpatch') or (sent.get(k) != v)}
+        sent.update(changed)
+        return json.dumps(changed) if changed else None
+
+    def websocket(self):
+        """Upgrade to a WebSocket and hand it to threads of its own, so it
+        doesn't hold a pool worker for as long as the page is open.  Past
+        the server's cap a 503 sends the page back to polling."""
+        key = self.headers.get('Sec-WebSocket-Key')
+        if key is None:
+            self.send_error(400, 'Bad WebSocket request')
+            return
+        if not self.server.websocketSlots.acquire(False):
+            self.send_error(503, 'Too many WebSocket connections')
+            return
+        self.wfile.write(("HTTP/1.1 101 Switching Protocols\r\n"
+                          "Upgrade: websocket\r\n"
+                          "Connection: Upgrade\r\n"
+                          "Sec-WebSocket-Accept: %s\r\n\r\n" % WebSocket.accept(key)).encode("ascii"))
+        self.wfile.flush()
+        self.close_connection = True
+        self.connection.settimeout(None)
+        self.upgraded = WebSocket(self)
+
+    def websocketPush(self, ws):
+        """Send state changes until the WebSocket closes, then let it go."""
+        sent = {}
+        seen = -1
+        try:
+            while not ws.closed:
+                msg = self.pushState(sent)
+                if msg is not None:
+                    ws.send(msg)
+                seq = updates.wait(seen, 25.0)
+                if seq == seen:
+                    ws.send(b"", 0x9)  # Idle, ping so dead clients get noticed
+                seen = seq
+        except OSError:
+            pass
+        finally:
+            ws.closed = True
+            self.server.websocketSlots.release()
+            self.server.release(self)
+
+    def websocketKeys(self, ws):
+        """Read keypresses sent over a WebSocket until it closes.  However
+        this ends, the push loop is told so its connection is let go."""
+        try:
+            while True:
+                msg = ws.recv()
+                if msg is None:
+                    break
+                try:
+                    msg = json.loads(msg)
+                except ValueError:
+                    continue
+                if not isinstance(msg, dict):
+                    continue
+                if ('key' in msg) and (self.screen is not None):
+                    self.screen.sendKey(msg['key'])
+                if ('keys' in msg) and (self.screen is not None):
+                    self.screen.sendKeys(msg['keys'])
+                if ('spakey' in msg) and (self.spa is not None):
+                    self.spa.sendKey(msg['spakey'])
+                if ('spakeys' in msg) and (self.spa is not None):
+                    self.spa.sendKeys(msg['spakeys'])
+        finally:
+            ws.closed = True
+            updates.bump()  # Wake the push loop so it notices the close
+
+    def api(self, postvars):
+        """JSON API, reachable by GET or POST."""
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/api/state":
+            self.sendVersion(self.state(), 'application/json')
+        elif (path == "/api/equipment") and (self.screen is not None):
+            self.sendVersion(self.screen.equipmentVersion(), 'application/json')
+        elif path == "/api/history":
+            self.sendBody(json.dumps(self.historyRange(postvars)), 'application/json')
+        elif path == "/api/events":
+            self.sendBody(json.dumps(self.eventRange(postvars)), 'application/json')
+        elif (path == "/api/navigate") and (self.screen is not None):
             try:
-                self.wfile.write(bytearray(ret, "UTF-8"))
-            except:
-                pass
+                timeout = float(postvars.get('timeout', [NAVTIMEOUT])[0])
+            except ValueError:
+                timeout = math.nan
+            if not math.isfinite(timeout):
+                self.send_error(400, 'Bad timeout')
+                return
+            timeout = min(max(timeout, 0), NAVTIMEOUT)  # Don't let one walk pin a worker
+            result = self.navigator.navigate(postvars.get('path', [''])[0], timeout)
+            self.sendBody(json.dumps(result), 'application/json')
         else:
             self.send_error(404, 'File Not Found: %s' % self.path)
 
+    def historyRange(self, postvars):
+        """Recorded points for series= between start= and end= (epoch
+        seconds, default the last hour), or the series names if none given."""
+        name = postvars.get('series', [None])[0]
+        if name is None:
+            return {'series': sorted(history.series), 'refused': history.refused}
+        try:
+            end = float(postvars.get('end', [time.time()])[0])
+            start = float(postvars.get('start', [end - 3600])[0])
+            res = postvars.get('res', [None])[0]
+            res = None if res is None else int(res)
+        except ValueError:
+            return {'error': 'bad start, end or res'}
+        result = history.query(name, start, end, res)
+        if result is None:
+            return {'error': 'unknown series', 'series': sorted(history.series)}
+        return result
+
+    def eventRange(self, postvars):
+        """Logged events between start= and end= (epoch seconds, default
+        the last hour), optionally only for device= (hex ID)."""
+        try:
+            end = float(postvars.get('end', [time.time()])[0])
+            start = float(postvars.get('start', [end - 3600])[0])
+            limit = int(postvars.get('limit', ['1000'])[0])
+            dev = postvars.get('device', [None])[0]
+            dev = None if dev is None else int(dev, 16)
+        except ValueError:
+            return {'error': 'bad start, end, limit or device'}
+        return {'events': events.query(start, end, dev, limit), 'log': events.stats()}
+
+    def state(self):
+        """(etag, JSON) of every emulated device, encoded once per change."""
+        parts = [dev.stateVersion() + (dev.ID,) if dev is not None else ('"-"', None, 0)
+                 for dev in (self.screen, self.spa)]
+        etag = '"' + "/".join("%02x:%s" % (part[2], part[0].strip('"')) for part in parts) + '"'
+        cache = webHandler.stateCache
+        if cache[0] != etag:
+            body = json.dumps({'screen': parts[0][1], 'spa': parts[1][1]})
+            cache = (etag, body)
+            webHandler.stateCache = cache
+        return cache
+
     def do_POST(self):
         """HTTP POST handler.  CGI "scripts" handled here."""
         try:
@@ -262,139 +1045,425 @@ class webHandler(BaseHTTPRequestHandler):
             postvars = urllib.parse.parse_qs(data, keep_blank_values=1)
         except:
             postvars = {}
+        if not self.route():
+            return
         if self.path.startswith("/cgi/"):
-            mimetype = 'text/html'
-            ret = ""
-            if self.path.startswith("/cgi/key.cgi"):
-                if 'key' in postvars:
-                    key = postvars['key'][0]
-                    self.screen.sendKey(key)
-                    ret = "<html><head><title>key</title></head><body>"+key+"</body></html>\n"
-            elif self.path.startswith("/cgi/spakey.cgi"):
-                if 'key' in postvars:
-                    key = postvars['key'][0]
-                    self.spa.sendKey(key)
-                    ret = "<html><head><title>key</title></head><body>"+key+"</body></html>\n"
-            elif self.path.startswith("/cgi/spabinary.cgi"):
-                ret = self.spa.text() + "|" + time.strftime("%_I:%M%P %_m/%d") + "|"
-                if self.spa.status['spa'] == "ON":
-                    ret += "1"
-                else:
-                    ret += "0"
-                if self.spa.status['heat'] == "ON":
-                    ret += "1"
-                else:
-                    ret += "0"
-                if self.spa.status['jets'] == "ON":
-                    ret += "1"
-                else:
-                    ret += "0"
-            elif self.path.startswith("/cgi/screen.cgi"):
-                ret = self.screen.html()
-            elif self.path.startswith("/cgi/spascreen.cgi"):
-                ret = self.spa.html()
-            elif self.path.startswith("/cgi/status.cgi"):
-                ret = str(self.screen.status)
-            elif self.path.startswith("/cgi/spastatus.cgi"):
-                ret = str(self.spa.status)
-            self.send_response(200)
-            self.send_header('Content-Type', mimetype)
-            self.end_headers()
-            try:
-                self.wfile.write(bytearray(ret, "UTF-8"))
-            except:
-                pass
+            self.cgi(postvars)
+        elif self.path.startswith("/api/"):
+            self.api(postvars)
         else:
             self.send_error(404, 'File Not Found: %s' % self.path)
 
-
-class MyServer(HTTPServer):
-    """Override some HTTPServer procedures to allow instance variables and timeouts."""
-    def serve_forever(self, screen, spa):
-        """Store the screen and spa objects and serve until end of times."""
+    def batchKeys(self, dev, postvars):
+        """Queue every key= and comma separated keys= value on a device."""
+        keys = postvars.get('key', [])
+        for value in postvars.get('keys', []):
+            keys += [key for key in value.split(",") if key]
+        rejected = dev.sendKeys(keys)
+        return json.dumps({'queued': len(keys) - len(rejected), 'rejected': rejected,
+                           'depth': dev.keys.depth()})
+
+    def cgi(self, postvars):
+        """CGI "scripts", reachable by GET or POST."""
+        mimetype = 'text/html'
+        ret = ""
+        if self.path.startswith("/cgi/keys.cgi"):
+            mimetype = 'application/json'
+            ret = self.batchKeys(self.screen, postvars)
+        elif self.path.startswith("/cgi/spakeys.cgi"):
+            mimetype = 'application/json'
+            ret = self.batchKeys(self.spa, postvars)
+        elif self.path.startswith("/cgi/keystats.cgi"):
+            mimetype = 'application/json'
+            ret = json.dumps({'screen': self.screen.keys.stats() if self.screen else None,
+                              'spa': self.spa.keys.stats() if self.spa else None})
+        elif self.path.startswith("/cgi/key.cgi"):
+            if 'key' in postvars:
+                key = postvars['key'][0]
+                self.screen.sendKey(key)
+                ret = "<html><head><title>key</title></head><body>"+key+"</body></html>\n"
+        elif self.path.startswith("/cgi/spakey.cgi"):
+            if 'key' in postvars:
+                key = postvars['key'][0]
+                self.spa.sendKey(key)
+                ret = "<html><head><title>key</title></head><body>"+key+"</body></html>\n"
+        elif self.path.startswith("/cgi/spabinary.cgi"):
+            snap = self.spa.snapshot
+            ret = snap.screen + "|" + time.strftime("%_I:%M%P %_m/%d") + "|"
+            if snap.status['spa'] == "ON":
+                ret += "1"
+            else:
+                ret += "0"
+            if snap.status['heat'] == "ON":
+                ret += "1"
+            else:
+                ret += "0"
+            if snap.status['jets'] == "ON":
+                ret += "1"
+            else:
+                ret += "0"
+        elif self.path.startswith("/cgi/screen.cgi"):
+            if 'since' in postvars:
+                mimetype = 'application/json'
+                ret = json.dumps(self.screen.delta(postvars['since'][0]))
+            else:
+                self.sendVersion(self.screen.htmlVersion(), mimetype)
+                return
+        elif self.path.startswith("/cgi/spascreen.cgi"):
+            self.sendVersion(self.spa.htmlVersion(), mimetype)
+            return
+        elif self.path.startswith("/cgi/status.cgi"):
+            self.sendVersion(self.screen.statusVersion(), mimetype)
+            return
+        elif self.path.startswith("/cgi/spastatus.cgi"):
+            self.sendVersion(self.spa.statusVersion(), mimetype)
+            return
+        elif self.path.startswith("/cgi/ackstats.cgi"):
+            mimetype = 'application/json'
+            ret = json.dumps(self.interface.watchdog.stats())
+        elif self.path.startswith("/cgi/trace.cgi"):
+            mimetype = 'application/json'
+            if self.link is not None:
+                self.link.wantTrace()
+            try:
+                limit = int(postvars.get('limit', ['100'])[0])
+            except ValueError:
+                limit = 100
+            ret = json.dumps(trace.recent(max(0, min(limit, trace.size))))
+        elif self.path.startswith("/cgi/busstats.cgi"):
+            mimetype = 'application/json'
+            ret = json.dumps(self.interface.busStats.stats())
+        self.sendBody(ret, mimetype)
+
+
+class IdleWatcher:
+    """Holds kept-alive connections between requests without a worker each.
+    One thread waits for any of them to become readable and hands that one
+    back to the pool, closing any left idle for longer than its timeout."""
+    TICK = 1.0  # Seconds between idle timeout checks
+
+    def __init__(self, server):
+        self.server = server
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.incoming = []
+        self.wakeRead, self.wakeWrite = socket.socketpair()
+        self.selector.register(self.wakeRead, selectors.EVENT_READ)
+        threading.Thread(target=self.run, name="http-idle", daemon=True).start()
+
+    def park(self, handler):
+        """Watch a handler's connection until its next request arrives."""
+        with self.lock:
+            self.incoming.append((handler, time.monotonic()))
+        self.wakeWrite.send(b"\0")
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select(self.TICK):
+                if key.fileobj is self.wakeRead:
+                    self.wakeRead.recv(4096)
+                    continue
+                self.selector.unregister(key.fileobj)
+                self.server.pool.submit(self.server.resume, key.data[0])
+            with self.lock:
+                incoming = self.incoming
+                self.incoming = []
+            for handler, since in incoming:
+                self.selector.register(handler.connection, selectors.EVENT_READ, (handler, since))
+            now = time.monotonic()
+            for key in list(self.selector.get_map().values()):
+                if (key.data is not None) and (now - key.data[1] >= key.data[0].timeout):
+                    self.selector.unregister(key.fileobj)
+                    self.server.release(key.data[0])
+
+
+class MyServer(socketserver.ThreadingMixIn, HTTPServer):
+    """Override some HTTPServer procedures to allow instance variables.
+    Requests are served by a bounded pool of worker threads, so a slow
+    client doesn't hold up everyone else.  Between requests a kept-alive
+    connection waits in the IdleWatcher rather than on a worker, and an
+    upgraded WebSocket runs on its own threads, up to a separate cap."""
+    daemon_threads = True
+    workers = HTTPWORKERS
+    websockets = WEBSOCKETS
+    pool = None
+
+    def serve_forever(self, screen, spa, interface, devices=None):
+        """Store the screen, spa and interface objects and serve until end of times.
+        Every device in devices (ID to device) is also served under /dev/<id>/."""
+        if devices is None:
+            devices = {dev.ID: dev for dev in (screen, spa) if dev is not None}
         self.RequestHandlerClass.screen = screen
         self.RequestHandlerClass.spa = spa
+        self.RequestHandlerClass.interface = interface
+        self.RequestHandlerClass.devices = devices
+        self.RequestHandlerClass.navigators = {devId: Navigator(dev) for devId, dev in devices.items()
+                                               if isinstance(dev, Screen)}
+        if screen is not None:
+            self.RequestHandlerClass.navigator = self.RequestHandlerClass.navigators[screen.ID]
+        self.RequestHandlerClass.assets = buildAssets()
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="http")
+        self.active = set()
+        self.websocketSlots = threading.BoundedSemaphore(self.websockets)
+        self.idle = IdleWatcher(self)
         HTTPServer.serve_forever(self)
-    def get_request(self):
-        """Get the request and client address from the socket."""
-        self.socket.settimeout(1.0)
-        result = None
-        while result is None:
+
+    def process_request(self, request, client_address):
+        """Queue the connection for the next free worker."""
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        """Serve a new connection, remembering it so shutdown can cut it off."""
+        self.active.add(request)
+        handler = None
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.settle(request, handler)
+
+    def resume(self, handler):
+        """Carry on serving a parked connection that has a new request."""
+        try:
+            handler.handle()
+            handler.finish()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+        finally:
+            self.settle(handler.request, handler)
+
+    def release(self, handler):
+        """Close a parked or upgraded connection that is done with."""
+        try:
+            BaseHTTPRequestHandler.finish(handler)
+        except OSError:
+            pass
+        self.active.discard(handler.request)
+        self.shutdown_request(handler.request)
+
+    def settle(self, request, handler):
+        """The worker is done with a connection: park it between requests,
+        start an upgraded one's WebSocket threads, or close it."""
+        if (handler is not None) and handler.parked:
+            self.idle.park(handler)
+        elif (handler is not None) and (handler.upgraded is not None):
+            handler.startWebsocket()
+        else:
+            self.active.discard(request)
+            self.shutdown_request(request)
+
+    def server_close(self):
+        """Stop listening, drop idle keep-alives and let the workers drain."""
+        HTTPServer.server_close(self)
+        for request in list(getattr(self, 'active', ())):
             try:
-                result = self.socket.accept()
-            except socket.timeout:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
                 pass
-        result[0].settimeout(1.0)
-        return result
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
 
 webServer = None
-def startServer(screen, spa, port):
+def startServer(screen, spa, port, interface, devices=None):
     """HTTP Server implementation, to be in separate thread from main code."""
     global webServer
     try:
         webServer = MyServer(('', port), webHandler)
         print('Started httpserver on port', port)
         # Wait forever for incoming http requests
-        webServer.serve_forever(screen, spa)
+        webServer.serve_forever(screen, spa, interface, devices)
     except KeyboardInterrupt:
         print('^C received, shutting down the web server')
         webServer.shutdown()
 
 
-class Spa:
+class KeyQueue:
+    """Bounded FIFO of keycodes for a device, one sent per ACK.  Web threads
+    append and the bus thread pops, both atomic on a deque, so taps faster
+    than the controller polls queue up instead of overwriting each other."""
+    GAP = 1  # Empty ACKs between presses so repeats read as separate taps
+
+    def __init__(self, size=None):
+        self.queue = collections.deque()
+        self.size = KEYQUEUE if size is None else size
+        self.idle = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.latencySum = 0.0
+        self.latencyMax = 0.0
+        self.recent = collections.deque(maxlen=16)
+
+    def put(self, code, name=None):
+        """Queue a keycode, False if the queue is full."""
+        if len(self.queue) >= self.size:
+            self.dropped += 1
+            return False
+        self.queue.append((code, name, time.monotonic()))
+        return True
+
+    def next(self):
+        """Keycode to send in this ACK, 0 if nothing is due."""
+        if self.idle > 0:
+            self.idle -= 1
+            return 0
+        try:
+            code, name, queued = self.queue.popleft()
+        except IndexError:
+            return 0
+        took = time.monotonic() - queued
+        self.delivered += 1
+        self.latencySum += took
+        self.latencyMax = max(self.latencyMax, took)
+        self.recent.append((name if name is not None else toHex(code), took))
+        self.idle = self.GAP
+        return code
+
+    def depth(self):
+        """Keys still waiting to go out."""
+        return len(self.queue)
+
+    def stats(self):
+        """Queue depth and delivery times for the web interface."""
+        return {'depth': len(self.queue), 'size': self.size,
+                'delivered': self.delivered, 'dropped': self.dropped,
+                'latencyMeanMs': round(self.latencySum / self.delivered * 1000, 1)
+                                 if self.delivered else 0,
+                'latencyMaxMs': round(self.latencyMax * 1000, 1),
+                'recent': [{'key': name, 'ms': round(took * 1000, 1)}
+                           for name, took in list(self.recent)]}
+
+
+class Snapshot:
+    """Immutable view of a device's state, published by the bus thread with a
+    single reference swap.  Web threads render from it without any locks and
+    memoise the results on the snapshot itself."""
+
+    def __init__(self, generation, fields):
+        self.generation = generation
+        self.etag = '"%s-%d"' % (Versioned.BOOT, generation)
+        self.rendered = {}
+        self.__dict__.update(fields)
+
+
+class Versioned:
+    """Generation counter and published snapshots for an emulated device.
+    Only the bus thread changes the device, and every real change publishes
+    a fresh Snapshot, so readers never stall processMessage.  The generation
+    only moves when visible state really changes, so cached renders and
+    ETags stay valid for as long as the display is idle."""
+    BOOT = "%x" % int(time.time())  # Keeps ETags from matching across restarts
+
+    def initVersion(self):
+        """Start at generation 0 and publish the initial state."""
+        self.generation = 0
+        self.processTime = Histogram(PROCESSBUCKETS)  # Bus thread time per state update
+        self.snapshot = Snapshot(self.generation, self.capture())
+
+    def changed(self):
+        """Visible state changed, publish it to the readers."""
+        self.generation += 1
+        self.snapshot = Snapshot(self.generation, self.capture())
+        updates.bump()
+
+    def cached(self, fmt, render):
+        """Return (etag, output) for a format from the current snapshot,
+        calling render(snapshot) only the first time it is asked for."""
+        snap = self.snapshot
+        out = snap.rendered.get(fmt)
+        if out is None:
+            out = render(snap)
+            snap.rendered[fmt] = out  # Racing readers just render it twice
+        return snap.etag, out
+
+    def processMessage(self, ret, i):
+        """Answer the controller, then run the command's handler from the
+        class's COMMANDS table."""
+        self.sendAck(i)
+        handler = self.COMMANDS.get(ret['cmd'])
+        if handler is None:
+            self.unknown(ret)
+        else:
+            generation = self.generation
+            start = time.perf_counter()
+            handler(self, ret['args'])
+            self.processTime.observe(time.perf_counter() - start)
+            if (self.generation != generation) and events.enabled:
+                events.state(self.ID, ret['cmd'], ret['args'])
+
+    def unknown(self, ret):
+        """A command with no handler, ignored unless a device says otherwise."""
+
+
+class Spa(Versioned):
     """Emulate spa-side controller with LCD display."""
-    lock = None
-    nextAck = 0x00
     status = {}
     ID = 0x20
     ACK = 0x00
+    PAGE = '/spa.html'
+    KEYS = {'1': 0x09, '2': 0x06, '3': 0x03, '4': 0x08, '5': 0x02,
+            '6': 0x07, '7': 0x04, '8': 0x01, '*': 0x05}  # Key name to ACK keycode
 
-    def __init__(self):
+    def __init__(self, devId=None):
+        if devId is not None:
+            self.ID = devId
         self.screen = "---"
         self.status = {'spa': "UNK", 'jets': "UNK", 'heat': "UNK"}
-        self.nextAck = 0x00
-        self.lock = threading.Lock()
+        self.keys = KeyQueue()
+        self.initVersion()
+
+    def capture(self):
+        """Copy of the state for a new snapshot."""
+        return {'screen': self.screen, 'status': dict(self.status)}
 
     def sendAck(self, i):
         """Tell controller we got messag, including keypresses in response."""
-        i.sendMsg(0x00, 0x01, [self.ACK, self.nextAck])
-        self.nextAck = 0x00
+        i.sendAck(self.ACK, self.keys.next())
 
-    def setNextAck(self, nextAck):
-        """Set value to send on next controller ping."""
-        self.nextAck = nextAck
+    def setNextAck(self, nextAck, name=None):
+        """Queue a value to send on a coming controller ping."""
+        queued = self.keys.put(nextAck, name)
+        if queued and events.enabled:
+            events.key(self.ID, name or toHex(nextAck))
+        return queued
 
     def sendKey(self, key):
-        """Send a key on the next ack"""
-        keyToAck = {'1': 0x09, '2': 0x06, '3': 0x03, '4': 0x08, '5': 0x02,
-                    '6': 0x07, '7': 0x04, '8': 0x01, '*': 0x05}
-        if key in list(keyToAck.keys()):
-            self.setNextAck(keyToAck[key])
+        """Queue a key for the next free ack, False if unknown or queue full"""
+        if key in self.KEYS:
+            return self.setNextAck(self.KEYS[key], key)
+        return False
+
+    def sendKeys(self, keys):
+        """Queue a sequence of keys, returning the ones that were rejected"""
+        return [key for key in keys if not self.sendKey(key)]
 
     def update(self, args):
         """Update the 7-segment LCD display."""
-        self.lock.acquire()
-        try:
-            text = chr(args[1]) + chr(args[2]) + chr(args[3])
-            if args[1:7] == [32, 46, 32, 46, 32, 46]: # " . . ."
-                self.screen = "... ..."
+        old = self.screen
+        text = chr(args[1]) + chr(args[2]) + chr(args[3])
+        if args[1:7] == [32, 46, 32, 46, 32, 46]: # " . . ."
+            self.screen = "... ..."
+        else:
+            self.screen = text
+            if args[5] == 1:
+                self.screen += " SET"
+            elif args[9] == 33:
+                self.screen += " AIR"
+            elif args[7] == 33:
+                self.screen += " H2O"
             else:
-                self.screen = text
-                if args[5] == 1:
-                    self.screen += " SET"
-                elif args[9] == 33:
-                    self.screen += " AIR"
-                elif args[7] == 33:
-                    self.screen += " H2O"
-                else:
-                    print(args.encode("UTF-8").hex())
-                if text == "0FF":
-                    self.screen = "OFF H2O"
-        finally:
-            self.lock.release()
+                print("Unknown spa display " + toHex(args))
+            if text == "0FF":
+                self.screen = "OFF H2O"
+        if self.screen != old:
+            self.changed()
+            if text.strip().isdigit() and self.screen.endswith(("AIR", "H2O")):
+                history.record("%02x.temp.%s" % (self.ID, self.screen[-3:].lower()),
+                               int(text))
 
     def setStatus(self, stat):
         """Process the status into a string for HTML return"""
+        old = dict(self.status)
         try:
             if stat[0] & 16:
                 self.status['spa'] = 'ON'
@@ -410,236 +1479,516 @@ class Spa:
                 self.status['heat'] = 'OFF'
         except:
             self.status = {'spa': "UNK", 'jets': "UNK", 'heat': "UNK"}
+        if self.status != old:
+            self.changed()
+            for name, state in self.status.items():
+                if state != "UNK":
+                    history.record("%02x.%s" % (self.ID, name), int(state == "ON"))
 
     def html(self):
         """Return HTML formatted 7-segment display"""
-        self.lock.acquire()
-        try:
-            ret = "<pre>" + self.screen + "</pre>"
-        finally:
-            self.lock.release()
-        return ret
+        return self.htmlVersion()[1]
+
+    def htmlVersion(self):
+        """Return (etag, html) of the 7-segment display"""
+        return self.cached('html', lambda snap: "<pre>" + snap.screen + "</pre>")
+
+    def statusVersion(self):
+        """Return (etag, text) of the equipment status"""
+        return self.cached('status', lambda snap: str(snap.status))
+
+    def stateVersion(self):
+        """Return (etag, dict) of the display and equipment status"""
+        return self.cached('state', lambda snap: {'screen': snap.screen,
+                                                  'status': snap.status})
 
     def text(self):
         """Return plain 7-character display"""
-        ret = self.screen
+        ret = self.snapshot.screen
         return ret
 
-    def processMessage(self, ret, i):
-        """Handle controller messages to us"""
-        self.sendAck(i)
-        if ret['cmd'] == 0x03:  # Text status
-            self.update(ret['args'])
-        elif ret['cmd'] == 0x09:  # Change send ??
-            try:
-                equip = ret['args'][0]
-                state = ret['args'][1]
-                print("Change code " + str(equip) + " to " + str(state))
-            except:
-                pass
-        elif ret['cmd'] == 0x02:  # Status binary
-            self.setStatus(ret['args'])
-        elif ret['cmd'] == 0x00:  # Probe
-            pass
-        else:
+    def onChange(self, args):
+        """Change send ??"""
+        try:
+            equip = args[0]
+            state = args[1]
+            print("Change code " + str(equip) + " to " + str(state))
+        except:
             pass
 
-class Screen:
+    def onProbe(self, args):
+        """Nothing to do beyond the ACK."""
+
+    COMMANDS = {0x00: onProbe,    # Probe
+                0x02: setStatus,  # Status binary
+                0x03: update,     # Text status
+                0x09: onChange}
+
+class Screen(Versioned):
     """Emulates the square remote control unit."""
     W = 16
     H = 12
     UNDERLINE = '\033[4m'
     END = '\033[0m'
-    lock = None
-    nextAck = 0x00
     ID = 0x40
     ACK = 0x8b
-
-    def __init__(self):
+    PAGE = '/square.html'
+    KEYS = {'up': 0x06, 'down': 0x05, 'back': 0x02, 'select': 0x04,
+            'pgup': 0x01, 'pgdn': 0x03}  # Key name to ACK keycode
+    TEMPERATURE = re.compile(r"\b(AIR|POOL|SPA)\b\D{0,8}?(-?\d{1,3})\s?(?:[`'\xb0][FC]?|[FC]\b)")
+    LABELS = re.compile(r"^\s*(?:(?:AIR|POOL|SPA)\b\s*)+$")    # PDA: names over a 0x82 line
+    DEGREES = re.compile(r"(-?\d{1,3})\s?[`'\xb0]")
+    EQUIPMENT = re.compile(r"^\s*([A-Z0-9][A-Z0-9 /.&-]*?)\s+(ON|OFF|ENA)\s*$")
+    CLOCK = re.compile(r"\b(\d{1,2}:\d{2}\s?[AP]M)\b")
+
+    def __init__(self, devId=None):
         """Set up the instance"""
+        if devId is not None:
+            self.ID = devId
         self.dirty = 1
         self.screen = self.W * [self.H * " "]
         self.invert = {'line':-1, 'start':-1, 'end':-1}
         self.status = "00000000"
-        self.lock = threading.Lock()
+        self.lineGen = len(self.screen) * [0]  # Generation each line last changed
+        self.equipment = {'generation': 0, 'equipment': {}, 'temperatures': {}, 'time': None}
+        self.parsedText = list(self.screen)  # Line text as parseLines last saw it
+        self.keys = KeyQueue()
+        self.initVersion()
         global INDEXHTML
         INDEXHTML = SQUAREHTML
 
+    def capture(self):
+        """Copy of the state for a new snapshot."""
+        return {'screen': tuple(self.screen), 'invert': dict(self.invert),
+                'status': self.status, 'lineGen': tuple(self.lineGen),
+                'equipment': self.equipment}
+
     def setStatus(self, status):
-        """Stuff status into a variable, but not used presently."""
-        self.status = status
+        """Stuff status into a variable for the state API."""
+        if self.status != status:
+            self.status = status
+            self.changed()
+            if status:
+                history.record("%02x.status" % self.ID, int(status[:12], 16))
+
+    def statusVersion(self):
+        """Return (etag, text) of the status bits"""
+        return self.cached('status', lambda snap: str(snap.status))
+
+    def stateVersion(self):
+        """Return (etag, dict) of lines, invert region and status bits"""
+        return self.cached('state', lambda snap: {'lines': snap.screen[0:self.H],
+                                                  'invert': snap.invert,
+                                                  'status': snap.status})
+
+    def changedLines(self, lines):
+        """Note which lines a change touched, then publish it."""
+        self.dirty = 1
+        for x in lines:
+            if 0 <= x < len(self.lineGen):
+                self.lineGen[x] = self.generation + 1
+        self.parseLines(lines)
+        self.changed()
+
+    def parseLine(self, x):
+        """(section, name, value) for each equipment state, temperature or
+        clock shown on line x.  A line of AIR/POOL/SPA names takes its
+        values from the degrees on the line below, as the PDA shows them."""
+        text = self.screen[x]
+        found = [('temperatures', name.lower(), int(temp))
+                 for name, temp in self.TEMPERATURE.findall(text)]
+        if self.LABELS.match(text) and (x + 1 < len(self.screen)):
+            temps = self.DEGREES.findall(self.screen[x + 1])
+            names = text.split()
+            if len(temps) == len(names):
+                found += [('temperatures', name.lower(), int(temp))
+                          for name, temp in zip(names, temps)]
+        equip = self.EQUIPMENT.match(text)
+        if equip and not found:
+            found.append(('equipment', " ".join(equip.group(1).split()), equip.group(2)))
+        clock = self.CLOCK.search(text)
+        if clock:
+            found.append(('time', None, clock.group(1)))
+        return found
+
+    def parseLines(self, lines):
+        """Re-read only the touched lines (and the ones above them, which may
+        be labels for them) and fold any new values into the equipment data,
+        which is replaced rather than changed so snapshots can share it."""
+        lines = [x for x in lines
+                 if (0 <= x < len(self.screen)) and (self.screen[x] != self.parsedText[x])]
+        if not lines:
+            return  # Only the highlight moved
+        found = []
+        for x in lines:
+            self.parsedText[x] = self.screen[x]
+        for x in set(lines) | set(x - 1 for x in lines):
+            if x >= 0:
+                found += self.parseLine(x)
+        old = self.equipment
+        new = None
+        for section, name, value in found:
+            current = old[section] if name is None else old[section].get(name)
+            if current == value:
+                continue
+            if new is None:
+                new = dict(old, equipment=dict(old['equipment']),
+                           temperatures=dict(old['temperatures']))
+            if name is None:
+                new[section] = value
+            else:
+                new[section][name] = value
+                if section == 'temperatures':
+                    history.record("%02x.temp.%s" % (self.ID, name), value)
+                else:
+                    history.record("%02x.%s" % (self.ID, name.lower().replace(" ", "_")),
+                                   int(value != "OFF"))
+        if new is not None:
+            new['generation'] = self.generation + 1
+            self.equipment = new
+
+    def equipmentVersion(self):
+        """Return (etag, JSON) of the equipment states and temperatures read
+        off the screen so far.  The ETag follows the generation the data last
+        changed in, so menus moving around don't defeat client caching."""
+        snap = self.snapshot  # Read once so the body and ETag agree
+        out = snap.rendered.get('equipment')
+        if out is None:
+            out = json.dumps(snap.equipment)
+            snap.rendered['equipment'] = out
+        return '"%s-e%d"' % (self.BOOT, snap.equipment['generation']), out
 
     def cls(self):
         """Clear the screen."""
-        self.lock.acquire()
-        try:
+        if (self.screen[0:12] != 12 * [""]) or (self.invert['line'] != -1):
+            lines = [i for i in range(0, 12) if self.screen[i] != ""]
+            lines.append(self.invert['line'])
             for i in range(0, 12):
                 self.screen[i] = ""
             self.invert['line'] = -1
-            self.dirty = 1
-        finally:
-            self.lock.release()
+            self.changedLines(lines)
 
     def scroll(self, start, end, direction):
         """Scroll screen up or down per controller request."""
-        self.lock.acquire()
-        try:
-            if direction == 255:  #-1
-                for x in range(start, end):
-                    self.screen[x] = self.screen[x+1]
-                self.screen[end] = self.W*" "
-            elif direction == 1:  # +1
-                for x in range(end, start, -1):
-                    self.screen[x] = self.screen[x-1]
-                self.screen[start] = self.W*" "
-            self.dirty = 1
-        finally:
-            self.lock.release()
+        old = list(self.screen)
+        if direction == 255:  #-1
+            for x in range(start, end):
+                self.screen[x] = self.screen[x+1]
+            self.screen[end] = self.W*" "
+        elif direction == 1:  # +1
+            for x in range(end, start, -1):
+                self.screen[x] = self.screen[x-1]
+            self.screen[start] = self.W*" "
+        if self.screen != old:
+            self.changedLines([x for x in range(len(old)) if self.screen[x] != old[x]])
 
     def writeLine(self, line, text):
         """"Controller sent new line for screen."""
-        self.lock.acquire()
-        try:
-            self.screen[line] = text + self.W*" "
-            self.screen[line] = self.screen[line][:self.W]
-            self.dirty = 1
-        finally:
-            self.lock.release()
+        text = (text + self.W*" ")[:self.W]
+        if self.screen[line] != text:  # Redraws of the same text don't count
+            self.screen[line] = text
+            self.changedLines([line])
 
     def invertLine(self, line):
         """Controller asked to invert entire line."""
-        self.lock.acquire()
-        try:
-            self.invert['line'] = line
-            self.invert['start'] = 0
-            self.invert['end'] = self.W
-            self.dirty = 1
-        finally:
-            self.lock.release()
+        self.invertChars(line, 0, self.W)
 
     def invertChars(self, line, start, end):
         """Controller asked to invert chars on a line."""
-        self.lock.acquire()
-        try:
-            self.invert['line'] = line
-            self.invert['start'] = start
-            self.invert['end'] = end
-            self.dirty = 1
-        finally:
-            self.lock.release()
+        invert = {'line': line, 'start': start, 'end': end}
+        if self.invert != invert:
+            lines = [self.invert['line'], line]
+            self.invert = invert
+            self.changedLines(lines)
 
     def show(self):
         """Print the screen to stdout."""
-        self.lock.acquire()
-        try:
-            if self.dirty:
-                self.dirty = 0
-                os.system("clear")
-                for i in range(0, self.H):
-                    if self.invert['line'] == i:
-                        sys.stdout.write(self.UNDERLINE)
-                    sys.stdout.write(self.screen[i])
-                    sys.stdout.write(self.END)
-                    sys.stdout.write("\n")
-                sys.stdout.write(self.W*"-" + "\n")
-                sys.stdout.write("STATUS: " + self.status + "\n")
-        finally:
-            self.lock.release()
+        if self.dirty:
+            self.dirty = 0
+            snap = self.snapshot
+            os.system("clear")
+            for i in range(0, self.H):
+                if snap.invert['line'] == i:
+                    sys.stdout.write(self.UNDERLINE)
+                sys.stdout.write(snap.screen[i])
+                sys.stdout.write(self.END)
+                sys.stdout.write("\n")
+            sys.stdout.write(self.W*"-" + "\n")
+            sys.stdout.write("STATUS: " + snap.status + "\n")
 
     def html(self):
         """Return the screen as a HTML element (<PRE> assumed)"""
-        self.lock.acquire()
-        try:
-            ret = "<pre>"
-            for x in range(0, self.H):
-                if x == self.invert['line']:
-                    for y in range(0, self.W):
-                        if y == self.invert['start']:
-                            ret += "<span style=\"background-color: #FFFF00\"><b>"
-                        ret += self.screen[x][y:y+1]
-                        if y == self.invert['end']:
-                            ret += "</b></span>"
-                    if self.invert['end'] == self.W:
-                        ret += "</b></span>"
-                    ret += "\n"
-                else:
-                    ret += self.screen[x] + "\n"
-            ret += "</pre>"
-        finally:
-            self.lock.release()
+        return self.htmlVersion()[1]
+
+    def htmlVersion(self):
+        """Return (etag, html) for the screen, rendering only after a change"""
+        return self.cached('html', self.renderHtml)
+
+    def renderHtml(self, snap):
+        """Build the HTML for a snapshot of the screen."""
+        ret = "<pre>"
+        for x in range(0, self.H):
+            ret += self.renderLine(snap, x) + "\n"
+        ret += "</pre>"
+        return ret
+
+    def renderLine(self, snap, x):
+        """HTML for a single line, with any inverted chars highlighted."""
+        invert = snap.invert
+        if x != invert['line']:
+            return snap.screen[x]
+        ret = ""
+        for y in range(0, self.W):
+            if y == invert['start']:
+                ret += "<span style=\"background-color: #FFFF00\"><b>"
+            ret += snap.screen[x][y:y+1]
+            if y == invert['end']:
+                ret += "</b></span>"
+        if invert['end'] == self.W:
+            ret += "</b></span>"
         return ret
 
+    def delta(self, since):
+        """Lines changed after version `since` ("boot-generation") as a dict
+        ready for JSON.  The whole screen is sent when the version is
+        unknown or when most of the lines changed anyway."""
+        try:
+            boot, gen = since.split("-")
+            gen = int(gen)
+        except (AttributeError, ValueError):
+            boot, gen = None, -1
+        snap = self.snapshot
+        lines = [x for x in range(0, self.H) if snap.lineGen[x] > gen]
+        full = (boot != self.BOOT) or (gen > snap.generation) or (len(lines) > self.H // 2)
+        if full:
+            lines = range(0, self.H)
+        return {'version': "%s-%d" % (self.BOOT, snap.generation),
+                'full': full,
+                'lines': {str(x): self.renderLine(snap, x) for x in lines},
+                'invert': snap.invert}
+
     def sendAck(self, i):
-        """Controller talked to us, send back our last keypress."""
-        i.sendMsg(0x00, 0x01, [self.ACK, self.nextAck])
-        self.nextAck = 0x00
+        """Controller talked to us, send back the next queued keypress."""
+        i.sendAck(self.ACK, self.keys.next())
 
-    def setNextAck(self, nextAck):
-        """Set the value we will send on the next ack, but don't send yet."""
-        self.nextAck = nextAck
+    def setNextAck(self, nextAck, name=None):
+        """Queue a value to send on a coming ack, but don't send yet."""
+        queued = self.keys.put(nextAck, name)
+        if queued and events.enabled:
+            events.key(self.ID, name or toHex(nextAck))
+        return queued
 
     def sendKey(self, key):
-        """Send a key (text) on the next ack."""
-        keyToAck = {'up': 0x06, 'down': 0x05, 'back': 0x02, 'select': 0x04,
-                    'pgup': 0x01, 'pgdn': 0x03}
-        if key in list(keyToAck.keys()):
-            self.setNextAck(keyToAck[key])
+        """Queue a key (text) for the next free ack, False if unknown or full."""
+        if key in self.KEYS:
+            return self.setNextAck(self.KEYS[key], key)
+        return False
+
+    def sendKeys(self, keys):
+        """Queue a sequence of keys, returning the ones that were rejected."""
+        return [key for key in keys if not self.sendKey(key)]
+
+    def onClear(self, args):
+        """Clear Screen"""
+        # What do the args mean?  Ignore for now
+        if args[0] == 0:
+            self.cls()
+        else:  # May be a partial clear?
+            self.cls()
+
+    def onScroll(self, args):
+        """Scroll Screen"""
+        start = args[0]
+        end = args[1]
+        direction = args[2]
+        self.scroll(start, end, direction)
+
+    def onWriteLine(self, args):
+        """Write a line"""
+        line = args[0]
+        offset = 1
+        text = ""
+        while ((offset < len(args)) and (args[offset] != 0)):
+            text += chr(args[offset])
+            offset = offset + 1
+        # The PDA has a special (double-wide?) mode identified by the MSBs
+        # Just move them to the top for now
+        if line == 64:
+            line = 0   # Time (hex=40)
+        if line == 130:
+            line = 2  # Temp (hex=82)
+        self.writeLine(line, text)
+
+    def onIgnore(self, args):
+        """PROBE, or the initial handshake (?), nothing beyond the ACK."""
+        # ??? After initial turn on get 0x05, rela box responds custom ack
+
+    def onStatus(self, args):
+        """Status?"""
+        self.setStatus(toHex(args))
+
+    def onInvertLine(self, args):
+        """Invert an entire line"""
+        self.invertLine(args[0])
+
+    def onInvertChars(self, args):
+        """Invert just some chars on a line"""
+        self.invertChars(args[0], args[1], args[2])
+
+    COMMANDS = {0x00: onIgnore,     # PROBE
+                0x02: onStatus,
+                0x04: onWriteLine,
+                0x05: onIgnore,     # Initial handshake?
+                0x08: onInvertLine,
+                0x09: onClear,
+                0x0f: onScroll,
+                0x10: onInvertChars}
+
+    def unknown(self, ret):
+        """Log commands we don't understand yet."""
+        print("unk: cmd=" + toHex(ret['cmd']) + " args=" + toHex(ret['args']))
+
+class Navigator:
+    """Walks the remote's menus for a path like "EQUIPMENT ON/OFF > SPA".
+    For each step it moves the highlight onto the line showing that text
+    (scrolling down when it isn't on screen) and presses select, waiting on
+    screen changes rather than fixed sleeps.  A step written as [key], e.g.
+    [back], just presses that key."""
+    KEYWAIT = 5.0    # Seconds for the screen to react to one key
+    MAXPRESSES = 40  # Up/down presses to reach an item before giving up
+
+    def __init__(self, screen):
+        self.screen = screen
+        self.lock = threading.Lock()  # One walk at a time
+
+    def find(self, text):
+        """Line number showing text (case insensitive), or -1."""
+        snap = self.screen.snapshot
+        text = text.upper()
+        for x in range(0, self.screen.H):
+            if text in snap.screen[x].upper():
+                return x
+        return -1
+
+    def settle(self, generation, deadline):
+        """Wait for the screen to move past generation, True if it did."""
+        seq = updates.seq
+        while self.screen.snapshot.generation == generation:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            seq = updates.wait(seq, remaining)
+        return True
+
+    def press(self, key, deadline):
+        """Press a key and wait for the screen to react to it."""
+        generation = self.screen.snapshot.generation
+        if not self.screen.sendKey(key):
+            return False
+        return self.settle(generation, min(deadline, time.monotonic() + self.KEYWAIT))
+
+    def waitFor(self, text, deadline):
+        """Wait for text to appear anywhere on the screen."""
+        while self.find(text) < 0:
+            if not self.settle(self.screen.snapshot.generation, deadline):
+                return False
+        return True
+
+    def step(self, target, deadline, report):
+        """Highlight target and select it, filling in report."""
+        if target.startswith("[") and target.endswith("]"):
+            key = target[1:-1].lower()
+            report['keys'].append(key)
+            if not self.press(key, deadline):
+                report['error'] = "no response to " + key
+            return 'error' not in report
+        self.waitFor(target, min(deadline, time.monotonic() + self.KEYWAIT))
+        for _ in range(self.MAXPRESSES):
+            line = self.find(target)
+            current = self.screen.snapshot.invert['line']
+            if (line >= 0) and (line == current):
+                report['keys'].append('select')
+                if not self.press('select', deadline):
+                    report['error'] = "no response to select"
+                return 'error' not in report
+            key = 'up' if (line >= 0) and (current > line) else 'down'
+            report['keys'].append(key)
+            if not self.press(key, deadline):
+                report['error'] = "not found" if line < 0 else "highlight did not move"
+                return False
+        report['error'] = "gave up after %d presses" % self.MAXPRESSES
+        return False
+
+    def navigate(self, path, timeout):
+        """Walk a "A > B > C" path, returning a report of each step."""
+        steps = [part.strip() for part in path.split(">") if part.strip()]
+        start = time.monotonic()
+        deadline = start + timeout
+        result = {'path': path, 'ok': False, 'steps': []}
+        if not self.lock.acquire(False):
+            result['error'] = "another navigation is running"
+            return result
+        try:
+            ok = True
+            for target in steps:
+                report = {'target': target, 'keys': []}
+                t0 = time.monotonic()
+                ok = self.step(target, deadline, report)
+                report['ok'] = ok
+                report['seconds'] = round(time.monotonic() - t0, 2)
+                result['steps'].append(report)
+                if not ok:
+                    break
+            result['ok'] = ok
+        finally:
+            self.lock.release()
+        result['seconds'] = round(time.monotonic() - start, 2)
+        return result
 
-    def processMessage(self, ret, i):
-        """Process message from a controller, updating internal state."""
-        self.sendAck(i)
-        if ret['cmd'] == 0x09:  # Clear Screen
-            # What do the args mean?  Ignore for now
-            if ret['args'][0] == 0:
-                self.cls()
-            else:  # May be a partial clear?
-                self.cls()
-        elif ret['cmd'] == 0x0f:  # Scroll Screen
-            start = ret['args'][0]
-            end = ret['args'][1]
-            direction = ret['args'][2]
-            self.scroll(start, end, direction)
-        elif ret['cmd'] == 0x04:  # Write a line
-            line = ret['args'][0]
-            offset = 1
-            text = ""
-            while ((offset < len(ret['args'])) and (ret['args'][offset] != 0)):
-                text += chr(ret['args'][offset])
-                offset = offset + 1
-            # The PDA has a special (double-wide?) mode identified by the MSBs
-            # Just move them to the top for now
-            if line == 64:
-                line = 0   # Time (hex=40)
-            if line == 130:
-                line = 2  # Temp (hex=82)
-            self.writeLine(line, text)
-        elif ret['cmd'] == 0x05:  # Initial handshake?
-            # ??? After initial turn on get this, rela box responds custom ack
-            pass
-        elif ret['cmd'] == 0x00:  # PROBE
-            pass
-        elif ret['cmd'] == 0x02:  # Status?
-            self.setStatus(toHex(ret['args']))
-        elif ret['cmd'] == 0x08:  # Invert an entire line
-            self.invertLine(ret['args'][0])
-        elif ret['cmd'] == 0x10:  # Invert just some chars on a line
-            self.invertChars(ret['args'][0], ret['args'][1], ret['args'][2])
-        else:
-            print("unk: cmd=" + toHex(ret['cmd']) + " args=" + toHex(ret['args']))
 
 class PDA(Screen):
     """Emulates the new PDA-style remote control unit."""
     ID = 0x60
     ACK = 0x40
     H = 10
+    PAGE = '/pda.html'
 
-    def __init__(self):
+    def __init__(self, devId=None):
         """Set up the instance"""
         global INDEXHTML
-        super(PDA, self).__init__()
+        super(PDA, self).__init__(devId)
         INDEXHTML = PDAHTML
 
 
+class DeviceRegistry:
+    """The emulated devices by bus address, so the main loop hands each
+    message to its device with one dict lookup however many there are."""
+
+    def __init__(self):
+        self.devices = {}
+
+    def add(self, dev):
+        """Register a device at its ID."""
+        if dev.ID in self.devices:
+            raise ValueError("Device ID %02x already emulated" % dev.ID)
+        self.devices[dev.ID] = dev
+        return dev
+
+    def first(self, cls):
+        """Lowest addressed device of a class, served at the old URLs."""
+        for devId in sorted(self.devices):
+            if isinstance(self.devices[devId], cls):
+                return self.devices[devId]
+        return None
+
+    def dispatch(self, ret, i):
+        """Pass a controller message to the device it is addressed to."""
+        dev = self.devices.get(ret['dest'])
+        if dev is not None:
+            dev.processMessage(ret, i)
+        return dev
+
+
 def log(*args):
     """Set the last log message"""
     global last_log
@@ -651,160 +2000,1309 @@ def log(*args):
 
 def toHex(blist):
     """Simple convert list of ints to a HEX string"""
-    if isinstance(blist, list):
+    if isinstance(blist, (list, bytes, bytearray)):
        return ''.join(format(x, "02x") for x in blist)
     elif isinstance(blist, int):
        return format(blist, "02x")
     else:
        return ''
 
+class FrameDecoder:
+    """Incremental RS485 frame decoder.
+    Feed it whatever bytes the port had waiting and it yields every complete
+    frame found so far, unstuffing DLE NUL pairs and keeping a running
+    checksum as it goes.  Partial frames are carried over to the next feed."""
+    MAXLEN = 128
+    BAD = {'dest': 0xff, 'cmd': 0xff, 'args': []}
+
+    def __init__(self):
+        self.frame = bytearray()
+        self.inFrame = False
+        self.escape = False      # Last byte seen in a frame was a DLE
+        self.pendingDLE = False  # Last byte seen while hunting was a DLE
+        self.sum = 0
+        self.frames = 0
+        self.badFrames = 0
+
+    def reset(self):
+        """Drop any partial frame and go back to hunting for DLE STX."""
+        self.frame = bytearray()
+        self.inFrame = False
+        self.escape = False
+        self.pendingDLE = False
+
+    def _start(self):
+        """A DLE STX was seen, begin collecting a new frame."""
+        self.frame = bytearray()
+        self.inFrame = True
+        self.escape = False
+        self.sum = DLE + STX
+
+    def _finish(self):
+        """A DLE ETX was seen, validate the collected frame."""
+        self.inFrame = False
+        frame = self.frame
+        if len(frame) >= 3:
+            check = frame[-1]
+            if ((self.sum - check) & 255) == check:
+                self.frames += 1
+                return {'dest': frame[0], 'cmd': frame[1], 'args': list(frame[2:-1])}
+        self.badFrames += 1
+        return self.BAD
+
+    def feed(self, data):
+        """Consume a chunk of raw bytes, yielding each complete frame."""
+        data = bytes(data)
+        view = memoryview(data)
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if not self.inFrame:
+                # Hunt for the next DLE STX, remembering a trailing DLE
+                if self.pendingDLE:
+                    self.pendingDLE = False
+                    if data[pos] == STX:
+                        pos += 1
+                        self._start()
+                        continue
+                idx = data.find(b'\x10\x02', pos)
+                if idx < 0:
+                    self.pendingDLE = data[end - 1] == DLE
+                    return
+                pos = idx + 2
+                self._start()
+            elif self.escape:
+                self.escape = False
+                byte = data[pos]
+                pos += 1
+                if byte == NUL:  # Stuffed DLE in the payload
+                    self.frame.append(DLE)
+                    self.sum += DLE
+                elif byte == ETX:
+                    yield self._finish()
+                elif byte == STX:  # Lost the end of the last frame, restart
+                    self.badFrames += 1
+                    yield self.BAD
+                    self._start()
+                else:  # Unstuffed DLE, garbage on the wire
+                    self.badFrames += 1
+                    yield self.BAD
+                    self.reset()
+                    pos -= 1
+            else:
+                # Copy everything up to the next DLE in one go
+                idx = data.find(DLE, pos)
+                stop = end if idx < 0 else idx
+                chunk = view[pos:stop]
+                self.frame += chunk
+                self.sum += sum(chunk)
+                pos = stop
+                if idx >= 0:
+                    pos += 1
+                    self.escape = True
+                if len(self.frame) > self.MAXLEN:
+                    self.badFrames += 1
+                    yield self.BAD
+                    self.reset()
+
+
+class CaptureWriter:
+    """Record the raw RS485 byte stream to a capture file.
+    The file is a short magic header followed by one record per serial read:
+    microseconds since the previous record (uint32), length (uint16), bytes."""
+    MAGIC = b"AQWCAP1\n"
+    RECORD = struct.Struct("<IH")
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(self.MAGIC)
+        self.last = time.monotonic()
+        self.bytes = 0
+
+    def record(self, data):
+        """Append one chunk of received bytes with its arrival time."""
+        now = time.monotonic()
+        delta = min(int((now - self.last) * 1000000), 0xffffffff)
+        self.last = now
+        for pos in range(0, len(data), 0xffff):
+            chunk = data[pos:pos + 0xffff]
+            self.file.write(self.RECORD.pack(delta, len(chunk)))
+            self.file.write(chunk)
+            delta = 0
+        self.bytes += len(data)
+
+    def close(self):
+        """Flush and close the capture."""
+        self.file.close()
+
+
+def readCapture(path):
+    """Load a capture file as a list of (seconds since start, bytes)."""
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(CaptureWriter.MAGIC):
+        raise ValueError("Not an aquaweb capture: " + path)
+    records = []
+    pos = len(CaptureWriter.MAGIC)
+    when = 0.0
+    size = CaptureWriter.RECORD.size
+    while pos + size <= len(data):
+        delta, length = CaptureWriter.RECORD.unpack_from(data, pos)
+        pos += size
+        when += delta / 1000000.0
+        records.append((when, data[pos:pos + length]))
+        pos += length
+    return records
+
+
+class ReplayPort:
+    """Serial port stand-in that plays back a capture file.
+    speed=1.0 replays in real time, larger values accelerate it and 0 feeds
+    the bytes as fast as they can be consumed.  Writes are discarded."""
+
+    def __init__(self, path, speed=1.0):
+        self.records = readCapture(path)
+        self.speed = speed
+        self.next = 0
+        self.buf = bytearray()
+        self.start = time.monotonic()
+        self.written = 0
+
+    def _due(self, when):
+        """Monotonic time at which a record captured at `when` is released."""
+        return self.start + when / self.speed
+
+    def _release(self, block):
+        """Move records that are due into the read buffer."""
+        while self.next < len(self.records) and len(self.buf) < 4096:
+            when, data = self.records[self.next]
+            if self.speed > 0:
+                wait = self._due(when) - time.monotonic()
+                if wait > 0:
+                    if not block or self.buf:
+                        return
+                    time.sleep(wait)
+            self.buf += data
+            self.next += 1
+
+    @property
+    def in_waiting(self):
+        self._release(False)
+        return len(self.buf)
+
+    def read(self, size=1):
+        """Return up to size bytes, raising EOFError at the end of the capture."""
+        if not self.buf:
+            self._release(True)
+            if not self.buf:
+                raise EOFError
+        ret = bytes(self.buf[:size])
+        del self.buf[:size]
+        return ret
+
+    def write(self, data):
+        self.written += len(data)
+        return len(data)
+
+
+class EventLog:
+    """Append-only binary log of state changes and keypresses in a directory
+    of segment files, kept across restarts.  Events collect in memory and
+    reach the SD card in EVENTBLOCK sized writes at most every EVENTFLUSH
+    seconds, fsync'd at most every EVENTSYNC, so a crash loses a minute of
+    events rather than the card wearing out.  Each segment starts with a
+    magic header and is named after its first event's time in ms; records
+    are time (double), kind, device ID and length (uint16), then the frame's
+    command and args for a STATE event or the key name for a KEY event."""
+    MAGIC = b"AQWEVT1\n"
+    RECORD = struct.Struct("<dBBH")
+    STATE = 1
+    KEY = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.enabled = path is not None
+        self.lock = threading.Lock()       # Guards the buffer
+        self.writeLock = threading.Lock()  # Guards the segment file
+        self.buf = bytearray()
+        self.file = None
+        self.size = 0
+        self.synced = time.monotonic()
+        self.wake = threading.Event()
+        self.stopped = False
+        self.writes = 0
+        self.syncs = 0
+        if self.enabled:
+            os.makedirs(path, exist_ok=True)
+            threading.Thread(target=self.flusher, name="eventlog", daemon=True).start()
+
+    def record(self, kind, dev, payload, now=None):
+        """Buffer one event, waking the writer once a block's worth is waiting."""
+        rec = self.RECORD.pack(time.time() if now is None else now, kind, dev, len(payload))
+        with self.lock:
+            self.buf += rec
+            self.buf += payload
+            full = len(self.buf) >= EVENTBLOCK
+        if full:
+            self.wake.set()
+
+    def state(self, dev, cmd, args):
+        """The frame that changed a device's state."""
+        self.record(self.STATE, dev, bytes([cmd]) + bytes(args))
+
+    def key(self, dev, key):
+        """A key queued for a device."""
+        self.record(self.KEY, dev, key.encode("UTF-8")[:255])
+
+    def flusher(self):
+        """Write the buffer out every EVENTFLUSH seconds or when it fills."""
+        while not self.stopped:
+            self.wake.wait(EVENTFLUSH)
+            self.wake.clear()
+            self.flush()
+
+    def segments(self):
+        """Segment file names, oldest first."""
+        return sorted(name for name in os.listdir(self.path)
+                      if name.startswith("events-") and name.endswith(".log"))
+
+    def flush(self, sync=False):
+        """Write what's buffered as one block, rotating segments as they fill."""
+        with self.writeLock:
+            with self.lock:
+                data = bytes(self.buf)
+                self.buf = bytearray()
+            if data:
+                self.write(data, sync)
+
+    def write(self, data, sync):
+        """Append a block to the current segment, starting one if needed."""
+        try:
+            if self.file is None:
+                first = self.RECORD.unpack_from(data)[0]
+                name = os.path.join(self.path, "events-%015d.log" % int(first * 1000))
+                self.file = open(name, "ab", buffering=0)
+                self.file.write(self.MAGIC)
+                self.size = len(self.MAGIC)
+            self.file.write(data)
+            self.size += len(data)
+            self.writes += 1
+            now = time.monotonic()
+            if sync or (self.size >= EVENTSEGMENT) or (now - self.synced >= EVENTSYNC):
+                os.fsync(self.file.fileno())
+                self.synced = now
+                self.syncs += 1
+            if self.size >= EVENTSEGMENT:
+                self.file.close()
+                self.file = None
+                self.size = 0
+                for name in self.segments()[:-EVENTSEGMENTS]:
+                    os.unlink(os.path.join(self.path, name))
+        except OSError as e:
+            print("WARNING: Unable to write event log: %s" % e)
+
+    def close(self):
+        """Write out and fsync everything buffered, e.g. on exit."""
+        if self.enabled:
+            self.stopped = True
+            self.wake.set()
+            self.flush(sync=True)
+
+    def parse(self, data, pos, start, end, dev, out, limit):
+        """Append the events in data[pos:] within the filters to out."""
+        size = self.RECORD.size
+        while (pos + size <= len(data)) and (len(out) < limit):
+            when, kind, devId, length = self.RECORD.unpack_from(data, pos)
+            pos += size
+            payload = bytes(data[pos:pos + length])
+            pos += length
+            if len(payload) < length:
+                break  # Cut short by a crash
+            if (when < start) or (when > end) or ((dev is not None) and (devId != dev)):
+                continue
+            event = {'time': round(when, 3), 'device': toHex(devId)}
+            if kind == self.KEY:
+                event['key'] = payload.decode("UTF-8", "replace")
+            else:
+                event['cmd'] = toHex(payload[0:1])
+                event['args'] = toHex(payload[1:])
+            out.append(event)
+
+    def query(self, start, end, dev=None, limit=1000):
+        """Events between start and end (epoch seconds), oldest first.
+        Segments that end before start are skipped by name, the rest are
+        mapped rather than read, then the unwritten buffer is checked."""
+        out = []
+        if not self.enabled:
+            return out
+        names = self.segments()
+        for n, name in enumerate(names):
+            if int(name[7:-4]) / 1000.0 > end:
+                break
+            if (n + 1 < len(names)) and (int(names[n + 1][7:-4]) / 1000.0 < start):
+                continue
+            with open(os.path.join(self.path, name), "rb") as f:
+                if os.fstat(f.fileno()).st_size <= len(self.MAGIC):
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    if data[:len(self.MAGIC)] == self.MAGIC:
+                        self.parse(data, len(self.MAGIC), start, end, dev, out, limit)
+        with self.lock:
+            pending = bytes(self.buf)
+        self.parse(pending, 0, start, end, dev, out, limit)
+        return out
+
+    def stats(self):
+        """Write counts, to check the log is going easy on the SD card."""
+        return {'writes': self.writes, 'fsyncs': self.syncs, 'buffered': len(self.buf),
+                'segment': self.size}
+
+events = EventLog(None)
+
+
+class AckWatchdog:
+    """Notice when the master resends a frame we already answered, which means
+    our ACK missed its response window, and keep per-device counts.  The
+    turnaround guard (time from end of read to our reply) is nudged within
+    [MIN_GUARD, MAX_GUARD] on each miss: shorter if we replied late, longer if
+    we replied on time but still weren't heard.  After SETTLE clean ACKs it
+    drifts back towards the nominal value."""
+    MIN_GUARD = 0.001
+    MAX_GUARD = 0.008
+    STEP = 0.0005
+    LATE = 0.002     # Reply this far past the guard counts as late
+    SETTLE = 200
+
+    def __init__(self, guard):
+        self.nominal = guard
+        self.guard = guard
+        self.enabled = guard > 0
+        self.last = None      # Key of the last frame sent to a device
+        self.answered = None  # (key, latency) of the frame we last replied to
+        self.clean = 0
+        self.devices = {}
+
+    def _device(self, dest):
+        """Per-device counters, created on first use."""
+        if dest not in self.devices:
+            self.devices[dest] = {'acks': 0, 'missed': 0, 'lastMissed': None,
+                                  'latencySum': 0.0, 'latencyMax': 0.0,
+                                  'histogram': Histogram(LATENCYBUCKETS)}
+        return self.devices[dest]
+
+    def received(self, ret, now):
+        """A valid frame was read, check whether it repeats one we answered."""
+        if ret['dest'] == 0x00:  # ACKs to the master, ours or another remote's
+            return
+        key = (ret['dest'], ret['cmd'], tuple(ret['args']))
+        if self.answered is not None:
+            if key == self.answered[0]:
+                self._missed(ret['dest'], self.answered[1], now)
+            else:
+                self._clean()
+        self.answered = None
+        self.last = key
+
+    def replied(self, latency):
+        """We just replied to the last frame read, latency after its read."""
+        if self.last is None:
+            return
+        self.answered = (self.last, latency)
+        dev = self._device(self.last[0])
+        dev['acks'] += 1
+        dev['latencySum'] += latency
+        dev['latencyMax'] = max(dev['latencyMax'], latency)
+        dev['histogram'].observe(latency)
+
+    def _missed(self, dest, latency, now):
+        """The master resent the frame, so our reply wasn't heard in time."""
+        dev = self._device(dest)
+        dev['missed'] += 1
+        dev['lastMissed'] = now
+        self.clean = 0
+        if self.enabled:
+            if latency > self.guard + self.LATE:
+                self.guard = max(self.MIN_GUARD, self.guard - self.STEP)
+            else:
+                self.guard = min(self.MAX_GUARD, self.guard + self.STEP)
+        trace.record(Tracer.MISS, dest, now, (latency, self.guard))
+
+    def _clean(self):
+        """Our reply was accepted, relax back towards the nominal guard."""
+        self.clean += 1
+        if self.clean >= self.SETTLE:
+            self.clean = 0
+            if self.guard > self.nominal:
+                self.guard = max(self.nominal, self.guard - self.STEP)
+            elif self.guard < self.nominal:
+                self.guard = min(self.nominal, self.guard + self.STEP)
+
+    def stats(self):
+        """Snapshot of the watchdog state for the web interface."""
+        now = time.monotonic()
+        devices = {}
+        for dest, dev in self.devices.items():
+            devices[toHex(dest)] = {
+                'acks': dev['acks'],
+                'missed': dev['missed'],
+                'secondsSinceMiss': None if dev['lastMissed'] is None
+                                    else round(now - dev['lastMissed'], 1),
+                'latencyMeanMs': round(dev['latencySum'] / dev['acks'] * 1000, 3)
+                                 if dev['acks'] else 0,
+                'latencyMaxMs': round(dev['latencyMax'] * 1000, 3)}
+        return {'guardMs': round(self.guard * 1000, 3),
+                'nominalGuardMs': round(self.nominal * 1000, 3),
+                'devices': devices}
+
+
+class Histogram:
+    """Fixed bucket histogram in the Prometheus style: cumulative counts
+    per upper bound, plus the sum and count.  observe() is a bisect and two
+    adds, cheap enough for the bus thread.  Callers with several writing
+    threads pass lock=True."""
+
+    def __init__(self, bounds, lock=False):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock() if lock else None
+
+    def observe(self, value):
+        """Count one sample."""
+        if self.lock is not None:
+            with self.lock:
+                self._add(value)
+        else:
+            self._add(value)
+
+    def _add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels=""):
+        """Exposition text lines for this histogram."""
+        out = []
+        total = 0
+        sep = "," if labels else ""
+        for bound, count in zip(list(self.bounds) + ["+Inf"], list(self.counts)):
+            total += count
+            out.append('%s_bucket{%s%sle="%s"} %d' % (name, labels, sep, bound, total))
+        labels = "{%s}" % labels if labels else ""
+        out.append("%s_sum%s %.6f" % (name, labels, self.sum))
+        out.append("%s_count%s %d" % (name, labels, self.count))
+        return out
+
+LATENCYBUCKETS = (0.0005, 0.001, 0.002, 0.003, 0.004, 0.005, 0.006, 0.008, 0.010, 0.020, 0.050)
+PROCESSBUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005)
+HTTPBUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class BusStats:
+    """Traffic totals for everything on the bus, not just frames for us.
+    Counts frames per destination and command, how often each destination
+    answered (the next frame being an ACK to the master), bytes against
+    what 9600 baud 8N1 can carry, and the gaps between frame arrivals.
+    Rates are over the last complete WINDOW seconds."""
+    BAUD = 9600
+    BITS = 10        # Start + 8 data + stop bits per byte
+    WINDOW = 10.0
+    GAPS = (0.002, 0.005, 0.010, 0.050, 0.200)  # Gap histogram bucket limits
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.bytes = 0
+        self.frames = 0
+        self.bad = 0
+        self.devices = {}
+        self.lastDest = None
+        self.lastTime = None
+        self.gaps = [0] * (len(self.GAPS) + 1)
+        self.gapSum = 0.0
+        self.gapCount = 0
+        self.gapMin = None
+        self.gapMax = 0.0
+        self.windowStart = self.start
+        self.windowTotals = (0, 0, 0)
+        self.rates = None
+
+    def data(self, count, now):
+        """count raw bytes arrived from the port."""
+        self.bytes += count
+        if now - self.windowStart >= self.WINDOW:
+            frames, nbytes, bad = self.windowTotals
+            span = now - self.windowStart
+            self.rates = {'seconds': round(span, 1),
+                          'framesPerSec': round((self.frames - frames) / span, 1),
+                          'badPerSec': round((self.bad - bad) / span, 2),
+                          'bytesPerSec': round((self.bytes - nbytes) / span, 1),
+                          'utilization': round((self.bytes - nbytes) * self.BITS / span / self.BAUD, 3)}
+            self.windowStart = now
+            self.windowTotals = (self.frames, self.bytes, self.bad)
+
+    def frame(self, ret, now):
+        """Account for one decoded (or BAD) frame read at now."""
+        if ret is FrameDecoder.BAD:
+            self.bad += 1
+            self.lastDest = None
+            return
+        self.frames += 1
+        if (self.lastTime is not None) and (now > self.lastTime):
+            gap = now - self.lastTime
+            bucket = 0
+            while (bucket < len(self.GAPS)) and (gap >= self.GAPS[bucket]):
+                bucket += 1
+            self.gaps[bucket] += 1
+            self.gapSum += gap
+            self.gapCount += 1
+            self.gapMax = max(self.gapMax, gap)
+            self.gapMin = gap if self.gapMin is None else min(self.gapMin, gap)
+        self.lastTime = now
+        dest = ret['dest']
+        dev = self.devices.get(dest)
+        if dev is None:
+            dev = {'frames': 0, 'bytes': 0, 'answered': 0, 'last': now, 'cmds': {}}
+            self.devices[dest] = dev
+        dev['frames'] += 1
+        dev['bytes'] += len(ret['args']) + 7  # Framing, less any DLE stuffing
+        dev['last'] = now
+        cmds = dev['cmds']
+        cmds[ret['cmd']] = cmds.get(ret['cmd'], 0) + 1
+        if (dest == 0x00) and (self.lastDest not in (None, 0x00)):
+            self.devices[self.lastDest]['answered'] += 1
+        self.lastDest = dest
+
+    def stats(self):
+        """Compact summary for the web interface."""
+        now = time.monotonic()
+        elapsed = max(now - self.start, 1e-6)
+        devices = {}
+        for dest, dev in self.devices.copy().items():
+            devices[toHex(dest)] = {
+                'frames': dev['frames'],
+                'perSec': round(dev['frames'] / elapsed, 2),
+                'bytes': dev['bytes'],
+                'answered': dev['answered'],
+                'secondsSinceSeen': round(now - dev['last'], 1),
+                'cmds': {toHex(cmd): count for cmd, count in dev['cmds'].copy().items()}}
+        limits = ["<%gms" % (limit * 1000) for limit in self.GAPS]
+        limits.append(">=%gms" % (self.GAPS[-1] * 1000))
+        total = self.frames + self.bad
+        return {'seconds': round(elapsed, 1),
+                'frames': self.frames,
+                'badFrames': self.bad,
+                'badRate': round(self.bad / total, 4) if total else 0,
+                'bytes': self.bytes,
+                'bytesPerSec': round(self.bytes / elapsed, 1),
+                'utilization': round(self.bytes * self.BITS / elapsed / self.BAUD, 3),
+                'recent': self.rates,
+                'gapMs': {'min': round(self.gapMin * 1000, 2) if self.gapMin is not None else None,
+                          'mean': round(self.gapSum / self.gapCount * 1000, 2) if self.gapCount else None,
+                          'max': round(self.gapMax * 1000, 2),
+                          'histogram': dict(zip(limits, self.gaps))},
+                'devices': devices}
+
+
+class Tracer:
+    """Flight recorder of bus traffic.  The bus thread only drops a
+    timestamp and a reference to the frame into preallocated slots of a
+    ring; formatting happens in a background thread when debug output is on,
+    or when the ring is read over HTTP, so tracing doesn't shift the ACK
+    timing it's there to watch.  The bus thread is the only writer."""
+    RAW, RX, BAD, TX, MISS = range(5)
+    KINDS = ("raw", "rx", "bad", "tx", "miss")
+    POLL = 0.05
+
+    def __init__(self, size=TRACESIZE):
+        self.size = size
+        self.times = [0.0] * size
+        self.kinds = [0] * size
+        self.data = [None] * size
+        self.extra = [None] * size
+        self.count = 0
+        self.name = "RS485"
+        self.printer = None
+
+    def record(self, kind, data, now, extra=None):
+        """Remember one event, data must not be changed afterwards."""
+        slot = self.count % self.size
+        self.times[slot] = now
+        self.kinds[slot] = kind
+        self.data[slot] = data
+        self.extra[slot] = extra
+        self.count += 1
+
+    def entries(self, since):
+        """(number, time, kind, data, extra) of everything recorded from
+        since on that is still in the ring."""
+        count = self.count
+        out = []
+        for n in range(max(since, 0, count - self.size), count):
+            slot = n % self.size
+            out.append((n, self.times[slot], self.kinds[slot], self.data[slot], self.extra[slot]))
+        first = self.count - self.size  # Drop any overwritten as we copied
+        return [entry for entry in out if entry[0] >= first]
+
+    def format(self, kind, data, extra):
+        """Turn an entry into the text debug output used to print inline."""
+        if kind == self.RX:
+            args = data['args']
+            ascii_args = str([chr(x) for x in args if chr(x) in string.printable])
+            return " ".join(["-->", toHex(data['dest']), toHex(data['cmd']),
+                             toHex(args), "\"" + ascii_args + "\""])
+        if kind == self.BAD:
+            return "--> *** bad checksum ***"
+        if kind == self.TX:
+            return " ".join(["<--", toHex(data[0:2]), toHex(data[2:3]), toHex(data[3:4]),
+                             toHex(data[4:-3]), toHex(data[-3:-2]), toHex(data[-2:]),
+                             "readToSendTime = %f" % extra])
+        if kind == self.MISS:
+            return "watchdog missed ACK deadline for %s latency %.1fms guard %.1fms" % (
+                toHex(data), extra[0] * 1000, extra[1] * 1000)
+        return "raw " + toHex(data)
+
+    def start(self):
+        """Print everything recorded from a background thread."""
+        if self.printer is None:
+            self.printer = threading.Thread(target=self.printLoop, name="trace", daemon=True)
+            self.printer.start()
+
+    def printLoop(self):
+        """Format and print new entries every POLL seconds, frames only with
+        debugData on."""
+        seen = self.count
+        while True:
+            time.sleep(self.POLL)
+            for n, _, kind, data, extra in self.entries(seen):
+                if n > seen:
+                    log(self.name, "*** %d trace entries lost ***" % (n - seen))
+                if kind == self.RAW:
+                    for pos in range(0, len(data), 48):
+                        log(self.name, toHex(data[pos:pos + 48]))
+                elif debugData:
+                    log(self.name, self.format(kind, data, extra))
+                seen = n + 1
+
+    def recent(self, limit):
+        """The last limit entries for the web interface, newest last."""
+        now = time.monotonic()
+        wall = time.time()
+        return [{'time': round(wall - (now - when), 4), 'kind': self.KINDS[kind],
+                 'text': self.format(kind, data, extra)}
+                for _, when, kind, data, extra in self.entries(self.count - limit)]
+
+trace = Tracer()
+
+
+class DeviceWatch:
+    """Sleep until a device node appears, woken by inotify on its directory
+    so a replugged adapter is picked up at once without polling.  Falls back
+    to plain sleeps where inotify isn't available."""
+    IN_ATTRIB = 0x004
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                mask = self.IN_CREATE | self.IN_ATTRIB | self.IN_MOVED_TO
+                if libc.inotify_add_watch(fd, os.path.dirname(path).encode(), mask) >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+        except (OSError, AttributeError, TypeError):
+            pass
+
+    def exists(self):
+        """Is the device node there right now?"""
+        return os.path.exists(self.path)
+
+    def wait(self, timeout):
+        """Sleep for timeout, or less if the missing device node turns up."""
+        if (self.fd is None) or self.exists():
+            time.sleep(timeout)
+            return
+        select.select([self.fd], [], [], timeout)
+        try:
+            while os.read(self.fd, 4096):  # Drain the events, we just re-check
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
 class Interface:
     """ Aqualink serial interface """
 
-    def __init__(self, theName):
+    def __init__(self, theName, port=None):
         """Initialization.
-        Open the serial port and find the start of a message."""
+        Open the serial port (unless one is passed in) and get the frame
+        decoder ready."""
         self.name = theName
-        if debugData:
-            log(self.name, "opening RS485 port", RS485Device)
-        self._open()
-        self.msg = [0x00, 0x00]
-        self.debugRawMsg = []
-        # skip bytes until synchronized with the start of a message
-        while (self.msg[-1] != STX) or (self.msg[-2] != DLE):
-            self.msg += self.port.read(1)
-            if debugRaw:
-                self.debugRaw(self.msg[-1])
-        self.msg = self.msg[-2:]
-        if debugData:
-            log(self.name, "synchronized")
-        # start up the read thread
+        if port is not None:
+            self.port = port
+        else:
+            if debugData:
+                log(self.name, "opening RS485 port", RS485Device)
+            self._open()
+        self.decoder = FrameDecoder()
+        self.pending = collections.deque()
+        self.capture = None
+        self.watchdog = AckWatchdog(ackGuard)
+        self.busStats = BusStats()
+        self.txbuf = bytearray()
+        self.ackFrames = {}
+        self.firstAck = True
+        self.reopens = 0
+        self.outageSeconds = 0.0  # Finished outages, see outageTime()
+        self.downSince = None     # When the current outage began
+        self.waiting = None  # Called when a read times out or between reconnect attempts
+        trace.name = theName
         log(self.name, "ready")
 
     def _open(self):
-        """Try and connect to the serial port, if it exists.  If not, then
-        add a small delay to avoid CPU hogging"""
+        """Try and connect to the serial port, leaving self.port None if it
+        can't be opened."""
         try:
-            if not os.path.exists(RS485Device):
-                print('Serial port \'' + RS485Device + '\' not found.\n')
-                sys.exit(-1)
             self.port = serial.Serial(RS485Device, baudrate=9600,
                                       bytesize=serial.EIGHTBITS,
                                       parity=serial.PARITY_NONE,
                                       stopbits=serial.STOPBITS_ONE,
                                       timeout=0.1)
-        except:
+        except (serial.SerialException, OSError, ValueError):
             self.port = None
 
+    def dropPort(self):
+        """Close a port that has failed so the next read reconnects."""
+        if self.port is not None:
+            try:
+                self.port.close()
+            except (serial.SerialException, OSError):
+                pass
+        self.port = None
+
+    def reconnect(self):
+        """Block until the serial port opens again.  Retries back off from
+        RECONNECTMIN to RECONNECTMAX seconds, but a missing device node
+        reappearing (the adapter replugged) wakes us straight away.  Any
+        partial frame is dropped so decoding resyncs on the next DLE STX."""
+        start = time.monotonic()
+        self.downSince = start
+        log(self.name, "waiting for", RS485Device)
+        self.decoder.reset()
+        self.pending.clear()
+        watch = DeviceWatch(RS485Device)
+        delay = RECONNECTMIN
+        try:
+            while True:
+                if watch.exists():
+                    self._open()
+                    if self.port is not None:
+                        break
+                if self.waiting is not None:
+                    self.waiting()
+                watch.wait(delay)
+                delay = min(delay * 2, RECONNECTMAX)
+        finally:
+            watch.close()
+        try:
+            self.port.reset_input_buffer()  # Whatever queued up is stale
+        except (serial.SerialException, OSError, AttributeError):
+            pass
+        outage = time.monotonic() - start
+        self.reopens += 1
+        self.outageSeconds += outage
+        self.downSince = None
+        log(self.name, "reconnected after a %.1f s outage" % outage)
+
+    def outageTime(self):
+        """Seconds spent without a serial port, including any outage still
+        going on."""
+        since = self.downSince
+        return self.outageSeconds + ((time.monotonic() - since) if since is not None else 0.0)
+
     def readMsg(self):
         """ Read the next valid message from the serial port.
         Parses and returns the destination address, command, and arguments as a
         tuple."""
         global lastReadMsgTime
-        
-        if self.port is None:
-            self._open()  # Try and re-open port
 
-        if self.port is None:  # We failed, return garbage
-            return {'dest': 0xff, 'cmd': 0xff, 'args': []}
-
-        while True:
-            dleFound = False
-            # Read what is probably the DLE STX
+        while not self.pending:
             try:
-                self.msg += self.port.read(2)
-            except serial.SerialException:
-                self.msg += [0x00, 0x00]
-                self._open()
+                if self.port is None:
+                    self.reconnect()
             except KeyboardInterrupt:
                 print("Keyboard exit requested.")
                 return {'stop':'1'}
-            while len(self.msg) < 2:
-                self.msg += [0x00]
+            try:
+                # Block for the first byte, then grab everything that's waiting
+                data = self.port.read(max(1, self.port.in_waiting))
+            except (serial.SerialException, OSError):
+                self.dropPort()
+                continue
+            except KeyboardInterrupt:
+                print("Keyboard exit requested.")
+                return {'stop':'1'}
+            except EOFError:  # End of a replayed capture
+                return {'stop':'1'}
+            if not data:
+                if self.waiting is not None:
+                    self.waiting()
+                continue
+            lastReadMsgTime = time.monotonic()
+            self.busStats.data(len(data), lastReadMsgTime)
+            if self.capture is not None:
+                self.capture.record(data)
             if debugRaw:
-                self.debugRaw(self.msg[-2])
-                self.debugRaw(self.msg[-1])
-            while (self.msg[-1] != ETX) or (not dleFound) or (len(self.msg) > 128):
-                # Read until DLE ETX
-                try:
-                    if self.port is None:
-                        return {'dest': 0xff, 'cmd': 0xff, 'args': []}
-                    self.msg += self.port.read(1)
-                except serial.SerialException:
-                    self.msg += [0x00]
-                    self._open()
-                except KeyboardInterrupt:
-                    print("Keyboard exit requested.")
-                    return {'stop':'1'}
-                if debugRaw:
-                    self.debugRaw(self.msg[-1])
-                if self.msg[-1] == DLE:
-                    # \x10 read, tentatively is a DLE
-                    dleFound = True
-                if (self.msg[-2] == DLE) and (self.msg[-1] == NUL) and dleFound:
-                    # skip a NUL following a DLE
-                    self.msg = self.msg[:-1]
-                    # it wasn't a DLE after all
-                    dleFound = False
-            # Skip any NULs between messages
-            while self.msg[0] == 0x00:
-                self.msg = self.msg[1:]
-            lastReadMsgTime = time.time()
-            # Parse the elements of the message
-            dlestx = self.msg[0:2]
-            dest = self.msg[2:3]
-            cmd = self.msg[3:4]
-            args = self.msg[4:-3]
-            checksum = self.msg[-3:-2]
-            dleetx = self.msg[-2:]
-            if debugData:
-                ascii_args = str([chr(x) for x in args if chr(x) in string.printable])
-                debugMsg = toHex(dlestx)+" "+toHex(dest)+" "+\
-                           toHex(cmd)+" "+toHex(args)+" \""+str(ascii_args)+"\" " +\
-                           toHex(checksum)+" "+toHex(dleetx)
-            self.msg = []
-            # Stop reading if a message with a valid checksum is read
-            if self.checksum(dlestx + dest + cmd + args) == checksum[0]:
-                if debugData:
-                    log(self.name, "-->", debugMsg)
-                return {'dest': dest[0], 'cmd': cmd[0], 'args': args}
-            else:
-                if debugData:
-                    log(self.name, "-->", debugMsg, "*** bad checksum ***")
-                return {'dest': 0xff, 'cmd': 0xff, 'args': []}
+                trace.record(Tracer.RAW, data, lastReadMsgTime)
+            self.pending.extend(self.decoder.feed(data))
+
+        ret = self.pending.popleft()
+        self.busStats.frame(ret, lastReadMsgTime)
+        if ret is not FrameDecoder.BAD:
+            trace.record(Tracer.RX, ret, lastReadMsgTime)
+            self.watchdog.received(ret, lastReadMsgTime)
+        else:
+            trace.record(Tracer.BAD, ret, lastReadMsgTime)
+        return ret
+
+    def startCapture(self, path):
+        """Record everything read from the bus into a capture file."""
+        self.capture = CaptureWriter(path)
+        log(self.name, "capturing to", path)
+
+    def stopCapture(self):
+        """Close any capture in progress."""
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
+    def encodeMsg(self, dest, cmd, args, out):
+        """Build a wire frame into the bytearray out, stuffing a NUL after
+        any DLE in the body."""
+        del out[:]
+        out += b'\x10\x02'
+        out.append(dest)
+        out.append(cmd)
+        out.extend(args)
+        out.append(sum(out) & 255)
+        if out.find(DLE, 2) >= 0:
+            out[2:] = out[2:].replace(b'\x10', b'\x10\x00')
+        out += b'\x10\x03'
+        return out
 
     def sendMsg(self, dest, cmd, args):
         """ Send a message. """
-        global lastReadMsgTime
-        msg = [DLE, STX, dest, cmd]
-        msg += args
-        msg += [self.checksum(msg), DLE, ETX]
-        for i in range(2, len(msg) - 2):
-            # If a byte in the message has the value \x10 insert a NUL after it
-            if msg[i] == DLE:
-                msg = msg[0:i+1] + [0x00] + msg[i+1:]
-        if debugData:
-            log(self.name, "<--", toHex(msg[0:2]),
-                toHex(msg[2:3]), toHex(msg[3:4]),
-                toHex(msg[4:-3]), toHex(msg[-3:-2]),
-                toHex(msg[-2:]))
-        now = time.time()
-        if ((now - lastReadMsgTime) < 0.004):
-            time.sleep(0.004 - (now - lastReadMsgTime))
-        self.port.write(msg)
-        if debugData:
-            readToSendTime = time.time() - lastReadMsgTime
-            print ("readToSendTime = %f\n" % readToSendTime)
+        self._write(self.encodeMsg(dest, cmd, args, self.txbuf))
+
+    def prepareAck(self, ack):
+        """Build the 256 ACK frames (one per keycode) for a device's ACK
+        byte, done as devices are created so sendAck only indexes a table."""
+        frames = self.ackFrames.get(ack)
+        if frames is None:
+            frames = tuple(bytes(self.encodeMsg(0x00, 0x01, [ack, k], bytearray()))
+                           for k in range(256))
+            self.ackFrames[ack] = frames
+        return frames
+
+    def sendAck(self, ack, key):
+        """Send a device ACK carrying a keycode from the prebuilt frames."""
+        frames = self.ackFrames.get(ack)
+        if frames is None:  # Only for devices created without createEmulators
+            frames = self.prepareAck(ack)
+        self._write(frames[key])
+        if self.firstAck:
+            self.firstAck = False
+            log(self.name, "first ACK %.3f s after start" % (time.monotonic() - startTime))
+
+    def _write(self, msg):
+        """Put a finished frame on the wire once the turnaround guard passes."""
+        guard = self.watchdog.guard
+        now = time.monotonic()
+        if ((now - lastReadMsgTime) < guard):
+            time.sleep(guard - (now - lastReadMsgTime))
+        try:
+            self.port.write(msg)
+        except (serial.SerialException, OSError, AttributeError):
+            self.dropPort()  # The next readMsg() waits for it to come back
+            return
+        readToSendTime = time.monotonic() - lastReadMsgTime
+        self.watchdog.replied(readToSendTime)
+        trace.record(Tracer.TX, msg if isinstance(msg, bytes) else bytes(msg),
+                     lastReadMsgTime + readToSendTime, readToSendTime)
+
     def checksum(self, msg):
         """ Compute the checksum of a string of bytes."""
         return sum(msg) & 255
 
-    def debugRaw(self, byte):
-        """ Debug raw serial data."""
-        self.debugRawMsg += [byte]
-        if (len(self.debugRawMsg) == 48) or (byte == ETX):
-            log(self.name, toHex(self.debugRawMsg))
-            self.debugRawMsg = []
+
+class SharedSlot:
+    """A block of shared memory written by one process and read by others,
+    guarded by a sequence lock: the writer makes the counter odd, copies the
+    data in and makes it even again, and a reader that saw it odd or saw it
+    move while copying just tries again.  Neither side ever waits for the
+    other, so no web request can hold up the bus process."""
+    HEADER = struct.Struct("<II")  # Sequence, length
+    SEQ = struct.Struct("<I")
+    TRIES = 1000  # Reads before giving up on a write that never finishes
+
+    def __init__(self, buf, offset, size):
+        self.buf = buf
+        self.offset = offset
+        self.start = offset + self.HEADER.size
+        self.size = size - self.HEADER.size
+
+    def sequence(self):
+        """Counter bumped by every write, odd while one is in progress."""
+        return self.SEQ.unpack_from(self.buf, self.offset)[0]
+
+    def write(self, data):
+        """Publish data, False if it doesn't fit."""
+        if len(data) > self.size:
+            return False
+        seq = self.sequence()
+        self.HEADER.pack_into(self.buf, self.offset, (seq + 1) & 0xffffffff, len(data))
+        self.buf[self.start:self.start + len(data)] = data
+        self.SEQ.pack_into(self.buf, self.offset, (seq + 2) & 0xffffffff)
+        return True
+
+    def read(self):
+        """(sequence, data) as last published, or None if a write stayed in
+        progress throughout, e.g. because the writer died in the middle."""
+        for _ in range(self.TRIES):
+            seq, length = self.HEADER.unpack_from(self.buf, self.offset)
+            if not seq & 1:
+                data = bytes(self.buf[self.start:self.start + min(length, self.size)])
+                if self.sequence() == seq:
+                    return seq, data
+            time.sleep(0)  # Let the writer finish
+        return None
+
+
+class SharedRing:
+    """Records of up to record-2 bytes passed one way between two processes
+    in shared memory.  Only the producer moves the head and only the
+    consumer moves the tail, so neither can block the other.  slots must be
+    a power of two."""
+    HEADER = struct.Struct("<II")  # Head, tail
+    INDEX = struct.Struct("<I")
+    LENGTH = struct.Struct("<H")
+
+    def __init__(self, buf, offset, slots, record):
+        self.buf = buf
+        self.offset = offset
+        self.slots = slots
+        self.record = record
+        self.bytes = self.HEADER.size + slots * record
+        self.dropped = 0
+
+    def put(self, data):
+        """Append a record, False if it is too long or the ring is full."""
+        head, tail = self.HEADER.unpack_from(self.buf, self.offset)
+        if (len(data) > self.record - self.LENGTH.size) or \
+           (((head - tail) & 0xffffffff) >= self.slots):
+            self.dropped += 1
+            return False
+        pos = self.offset + self.HEADER.size + (head % self.slots) * self.record
+        self.LENGTH.pack_into(self.buf, pos, len(data))
+        pos += self.LENGTH.size
+        self.buf[pos:pos + len(data)] = data
+        self.INDEX.pack_into(self.buf, self.offset, (head + 1) & 0xffffffff)
+        return True
+
+    def get(self):
+        """Every waiting record, oldest first."""
+        head, tail = self.HEADER.unpack_from(self.buf, self.offset)
+        out = []
+        while tail != head:
+            pos = self.offset + self.HEADER.size + (tail % self.slots) * self.record
+            length = self.LENGTH.unpack_from(self.buf, pos)[0]
+            pos += self.LENGTH.size
+            out.append(bytes(self.buf[pos:pos + length]))
+            tail = (tail + 1) & 0xffffffff
+        if out:
+            self.INDEX.pack_into(self.buf, self.offset + self.INDEX.size, tail)
+        return out
+
+
+class BusLink:
+    """Everything the bus process and the web process share with --split.
+    One SharedSlot per device holds its latest Snapshot and another the bus
+    process's statistics, a SharedRing carries keypresses to the bus and
+    another carries history and event records back, and a pipe wakes the
+    web side when there is something new.  The bus side only ever does a
+    few struct operations per frame, plus a pickle when state changed."""
+    CONTROL = struct.Struct("<d")   # Monotonic time until which trace entries are wanted
+    KEY = struct.Struct("<BB14s")   # Device ID, keycode, key name
+    REPORTSIZE = 1 << 20
+    KEYSLOTS = 256
+    FEEDSLOTS = 4096
+    FEEDRECORD = 128
+
+    def __init__(self, devIds):
+        devIds = sorted(devIds)
+        keyRecord = SharedRing.LENGTH.size + self.KEY.size
+        size = (self.CONTROL.size + self.REPORTSIZE + len(devIds) * SPLITSLOT +
+                SharedRing.HEADER.size + self.KEYSLOTS * keyRecord +
+                SharedRing.HEADER.size + self.FEEDSLOTS * self.FEEDRECORD)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        buf = self.shm.buf
+        offset = self.CONTROL.size
+        self.report = SharedSlot(buf, offset, self.REPORTSIZE)
+        offset += self.REPORTSIZE
+        self.slots = {}
+        for devId in devIds:
+            self.slots[devId] = SharedSlot(buf, offset, SPLITSLOT)
+            offset += SPLITSLOT
+        self.keys = SharedRing(buf, offset, self.KEYSLOTS, keyRecord)
+        offset += self.keys.bytes
+        self.feed = SharedRing(buf, offset, self.FEEDSLOTS, self.FEEDRECORD)
+        self.wakeRead, self.wakeWrite = os.pipe()
+        os.set_blocking(self.wakeWrite, False)
+        self.keyLock = threading.Lock()  # Web threads take turns as the ring's one producer
+        self.published = {}
+        self.pending = False
+        self.lastReport = 0.0
+        self.traceSeen = 0
+
+    # Bus process side
+
+    def publish(self, dev):
+        """Copy a device's snapshot into its slot if it moved on, True if so."""
+        snap = dev.snapshot
+        if self.published.get(dev.ID) == snap.generation:
+            return False
+        fields = {k: v for k, v in snap.__dict__.items()
+                  if k not in ('generation', 'etag', 'rendered')}
+        if not self.slots[dev.ID].write(pickle.dumps((snap.generation, fields), -1)):
+            log("Bus", "state of %02x is too big to share" % dev.ID)
+        self.published[dev.ID] = snap.generation
+        return True
+
+    def send(self, record):
+        """Queue a history or event record for the web process."""
+        self.feed.put(pickle.dumps(record, -1))
+        self.pending = True
+
+    def afterFrame(self, i, registry, dev):
+        """Run after each frame is dispatched: take in keys from the web,
+        publish any change, and every SPLITREPORT seconds send the
+        statistics.  The report waits for one of our ACKs, when the master
+        is busy polling someone else, but for no more than another period,
+        so it still flows while sniffing or when our devices go unpolled."""
+        for data in self.keys.get():
+            devId, code, name = self.KEY.unpack(data)
+            target = registry.devices.get(devId)
+            if target is not None:
+                target.keys.put(code, name.rstrip(b"\0").decode() or None)
+        woke = self.pending
+        self.pending = False
+        if dev is not None:
+            woke = self.publish(dev) or woke
+        due = time.monotonic() - self.lastReport
+        if (due >= 2 * SPLITREPORT) or ((due >= SPLITREPORT) and (dev is not None)):
+            self.sendReport(i, registry)
+            woke = True
+        if woke:
+            self.wake()
+
+    def idle(self, i, registry):
+        """Keep the statistics coming while the bus is quiet or the serial
+        port is down."""
+        if time.monotonic() - self.lastReport >= SPLITREPORT:
+            self.sendReport(i, registry)
+            self.wake()
+
+    def wake(self):
+        """Tell the web side there is something new."""
+        try:
+            os.write(self.wakeWrite, b"\0")
+        except BlockingIOError:
+            pass  # Already plenty of wakeups waiting
+
+    def sendReport(self, i, registry):
+        """Publish the Interface's and devices' statistics, and the trace
+        entries since the last report if the web side is looking at them."""
+        self.lastReport = time.monotonic()
+        entries = None
+        if self.lastReport < self.CONTROL.unpack_from(self.shm.buf, 0)[0]:
+            entries = trace.entries(self.traceSeen)
+        self.traceSeen = trace.count
+        report = {'busStats': i.busStats, 'watchdog': i.watchdog, 'reopens': i.reopens,
+                  'outageSeconds': i.outageTime(),
+                  'keys': {devId: dev.keys for devId, dev in registry.devices.items()},
+                  'processTime': {devId: dev.processTime
+                                  for devId, dev in registry.devices.items()},
+                  'trace': entries}
+        if not self.report.write(pickle.dumps(report, -1)):
+            log("Bus", "statistics report is too big to share")
+
+    # Web process side
+
+    def sendKey(self, devId, code, name):
+        """Pass a keypress to the bus process, False if the ring is full."""
+        with self.keyLock:
+            return self.keys.put(self.KEY.pack(devId, code, (name or "").encode()[:14]))
+
+    def wantTrace(self):
+        """Have the bus process send trace entries for the next minute."""
+        self.CONTROL.pack_into(self.shm.buf, 0, time.monotonic() + 60)
+
+    def reader(self, registry, mirror, alive):
+        """Web side thread: apply whatever the bus process sent, then wake
+        the web clients.  A torn read just waits for the next pass, unless
+        alive() says the bus process is gone."""
+        seen = {}
+        reportSeen = 0
+        while True:
+            try:
+                if select.select([self.wakeRead], [], [], SPLITREPORT)[0]:
+                    os.read(self.wakeRead, 4096)
+            except (OSError, ValueError):
+                return  # Closed on the way out
+            for data in self.feed.get():
+                try:
+                    record = pickle.loads(data)
+                except Exception:
+                    continue
+                if record[0] == 'history':
+                    history.record(*record[1:])
+                elif events.enabled:
+                    events.record(EventLog.STATE, record[1], record[2], record[3])
+            changed = False
+            for devId, slot in self.slots.items():
+                if slot.sequence() == seen.get(devId):
+                    continue
+                got = slot.read()
+                if got is None:
+                    if not alive():
+                        log("Bus", "process died while publishing, stopping updates")
+                        return
+                    continue
+                seq, data = got
+                try:
+                    generation, fields = pickle.loads(data)
+                except Exception:
+                    continue
+                dev = registry.devices[devId]
+                dev.generation = generation
+                dev.snapshot = Snapshot(generation, fields)
+                seen[devId] = seq
+                changed = True
+            if changed:
+                updates.bump()
+            if self.report.sequence() != reportSeen:
+                got = self.report.read()
+                if got is None:
+                    if not alive():
+                        log("Bus", "process died while reporting, stopping updates")
+                        return
+                    continue
+                seq, data = got
+                try:
+                    report = pickle.loads(data)
+                except Exception:
+                    continue
+                reportSeen = seq
+                mirror.update(report)
+                for devId, dev in registry.devices.items():
+                    dev.keys.report = report['keys'][devId]
+                    dev.processTime = report['processTime'][devId]
+                for _, when, kind, data, extra in report['trace'] or ():
+                    trace.record(kind, data, when, extra)
+
+    def close(self):
+        """Free the shared memory, from the process that created it."""
+        os.close(self.wakeRead)
+        os.close(self.wakeWrite)
+        self.shm.close()
+        self.shm.unlink()
+
+
+class LinkFeed:
+    """Stands in for the history and event log in the bus process with
+    --split, passing records to the web process which keeps the real ones."""
+
+    def __init__(self, link, enabled):
+        self.link = link
+        self.enabled = enabled
+
+    def record(self, name, value, now=None):
+        """History.record() for the web process."""
+        self.link.send(('history', name, value, time.time() if now is None else now))
+
+    def state(self, dev, cmd, args):
+        """EventLog.state() for the web process."""
+        self.link.send(('event', dev, bytes([cmd]) + bytes(args), time.time()))
+
+    def close(self):
+        """Nothing buffered here."""
+
+
+class RemoteKeys:
+    """Stands in for a device's KeyQueue in the web process with --split:
+    keys go to the bus process through the BusLink and the statistics are
+    those of its last report."""
+
+    def __init__(self, link, devId):
+        self.link = link
+        self.devId = devId
+        self.report = KeyQueue()
+
+    def put(self, code, name=None):
+        """Send a keycode to the bus process's queue, False if it's backed up."""
+        return self.link.sendKey(self.devId, code, name)
+
+    def depth(self):
+        return self.report.depth()
+
+    def stats(self):
+        return self.report.stats()
+
+
+class BusMirror:
+    """Stands in for the Interface in the web process with --split, holding
+    the bus process's counters as of its last report."""
+
+    def __init__(self):
+        self.busStats = BusStats()
+        self.watchdog = AckWatchdog(ackGuard)
+        self.reopens = 0
+        self.outageSeconds = 0.0
+
+    def update(self, report):
+        """Take the counters from a report."""
+        for name in ('busStats', 'watchdog', 'reopens', 'outageSeconds'):
+            setattr(self, name, report[name])
+
+    def outageTime(self):
+        """Seconds without a serial port as of the last report."""
+        return self.outageSeconds
+
+
+def raisePriority(priority):
+    """Move this process into the SCHED_FIFO real-time class, or failing
+    that nice it up, so a frame arriving gets the CPU at once."""
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        log("Bus", "running at SCHED_FIFO priority %d" % priority)
+        return
+    except (OSError, AttributeError) as e:
+        print("WARNING: Unable to use SCHED_FIFO (%s), trying nice instead" % e)
+    try:
+        os.nice(-10)
+        log("Bus", "running at nice %d" % os.nice(0))
+    except OSError as e:
+        print("WARNING: Unable to raise the bus process's priority: %s" % e)
 
 
 def parseArgs():
@@ -817,86 +3315,369 @@ def parseArgs():
                                             "* Jandy remote PDA or OneLink Controller")
     parser.add_argument("--device", "-d", dest="device", default="/dev/ttyUSB0",
                         help="RS485 device, default=dev/ttyUSB0", required=False)
-    parser.add_argument("--spalink", "-s", dest="spalink", action='store_true',
-                        help="Enable a SPALINK emulator at http://localhost/spa.html",
-                        default=False, required=False)
+    parser.add_argument("--spalink", "-s", dest="spalink", type=int, nargs='?', const=1,
+                        help="Enable SPALINK emulators (default 1, up to 4) at "
+                             "http://localhost/spa.html and /dev/20/ onwards",
+                        default=0, required=False)
     parser.add_argument("--pda", "-p", dest="pda", action='store_true',
                         help="Enable a PDA emulator at http://localhost/", default=False,
                         required=False)
-    parser.add_argument("--aqualink", "-a", dest="aqualink", action='store_true',
-                        help="Enable a AQUALINK emulator at http://localhost/", default=False,
+    parser.add_argument("--aqualink", "-a", dest="aqualink", type=int, nargs='?', const=1,
+                        help="Enable AQUALINK emulators (default 1, up to 4) at "
+                             "http://localhost/ and /dev/40/ onwards", default=0,
                         required=False)
+    parser.add_argument("--sniff", dest="sniff", action='store_true',
+                        help="Emulate nothing, just collect bus traffic statistics for "
+                             "/cgi/busstats.cgi", default=False, required=False)
     parser.add_argument("--port", "-P", dest="port", type=int, default=PORT,
                         help="bind to http://localhost:port/ instead of default http port",
                         required=False)
+    parser.add_argument("--http-workers", dest="httpWorkers", type=int, default=HTTPWORKERS,
+                        help="Maximum concurrent HTTP connections, default=%d" % HTTPWORKERS,
+                        required=False)
+    parser.add_argument("--http-idle", dest="httpIdle", type=float, default=HTTPIDLE,
+                        help="Seconds before an idle HTTP keep-alive connection is closed, "
+                             "default=%d" % HTTPIDLE, required=False)
+    parser.add_argument("--websockets", dest="websockets", type=int, default=WEBSOCKETS,
+                        help="Maximum open WebSockets before pages fall back to polling, "
+                             "default=%d" % WEBSOCKETS, required=False)
+    parser.add_argument("--assets", dest="assets", default=None,
+                        help="Directory of files to serve in place of or alongside the "
+                             "built-in pages", required=False)
+    parser.add_argument("--detect-cache", dest="detectCache", default=DETECTCACHE,
+                        help="File remembering auto-detected devices so the next start "
+                             "serves at once, \"\" to disable, default=%s" % DETECTCACHE,
+                        required=False)
+    parser.add_argument("--event-log", dest="eventLog", default=None,
+                        help="Directory to keep a persistent log of state changes and "
+                             "keypresses in", required=False)
+    parser.add_argument("--split", dest="split", action='store_true',
+                        help="Run the RS485 bus loop in its own process, sharing state with "
+                             "the web server through shared memory", default=False,
+                        required=False)
+    parser.add_argument("--realtime", dest="realtime", type=int, nargs='?',
+                        const=SPLITPRIORITY, default=0,
+                        help="With --split, run the bus process at this SCHED_FIFO priority "
+                             "(default %d) or failing that a raised nice level" % SPLITPRIORITY,
+                        required=False)
+    parser.add_argument("--debug", dest="debug", action='store_true',
+                        help="Print every frame read and sent (from a background thread)",
+                        default=False, required=False)
+    parser.add_argument("--debug-raw", dest="debugRaw", action='store_true',
+                        help="Also print the raw bytes as they are read", default=False,
+                        required=False)
+    parser.add_argument("--record", "-r", dest="record", default=None,
+                        help="Record the raw RS485 traffic to a capture file", required=False)
+    parser.add_argument("--replay", "-R", dest="replay", default=None,
+                        help="Replay a capture file through the emulators instead of the RS485 "
+                             "device and report timings", required=False)
+    parser.add_argument("--speed", dest="speed", type=float, default=0.0,
+                        help="Replay speed, 1.0=real time, 0=as fast as possible (default)",
+                        required=False)
     args = parser.parse_args()
-    if not os.path.exists(args.device):
+    if (args.replay is None) and (not os.path.exists(args.device)):
         print("ERROR: Unable to open RS485 device: " + args.device + "\n")
         sys.exit(2)
+    if args.sniff and (args.pda or args.aqualink or args.spalink):
+        print("ERROR: --sniff doesn't emulate, so can't be combined with a device.")
+        sys.exit(2)
     if args.pda and args.aqualink:
         print("ERROR: Only one of --pda or --aqualink may be specified, not both.")
         sys.exit(2)
+    if args.realtime and not args.split:
+        print("ERROR: --realtime only applies to the bus process of --split.")
+        sys.exit(2)
+    if not ((0 <= args.aqualink <= 4) and (0 <= args.spalink <= 4)):
+        print("ERROR: The bus has room for at most 4 remotes and 4 SpaLinks.")
+        sys.exit(2)
     return args
 
+def detectDevice(ret, args):
+    """Turn on emulation of whatever device a controller message was sent to."""
+    if (ret['dest'] == Screen.ID) and (not args.aqualink):
+        print("...Detected old-style Aqualink pad.")
+        args.aqualink = 1
+    if (ret['dest'] == PDA.ID) and (not args.pda):
+        print("...Detected new-style Aqualink PDA.")
+        args.pda = True
+    if (ret['dest'] == Spa.ID) and (not args.spalink):
+        print("...Detected SpaLink controller.")
+        args.spalink = 1
+
+class Detector:
+    """Watch the controller's probe cycle for device IDs we can emulate.
+    Done once every one of them has been addressed twice and no new
+    destination has turned up for DETECTQUIET seconds, or at DETECTTIME."""
+    IDS = (Screen.ID, PDA.ID, Spa.ID)
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.lastNew = self.start
+        self.counts = {}
+        self.done = False
+
+    def feed(self, ret, now):
+        """Count one controller message, returns True when detection is over."""
+        dest = ret['dest']
+        if dest != FrameDecoder.BAD['dest']:
+            count = self.counts.get(dest, 0)
+            if count == 0:
+                self.lastNew = now
+            self.counts[dest] = count + 1
+        if now - self.start >= DETECTTIME:
+            self.done = True
+        elif now - self.lastNew >= DETECTQUIET:
+            seen = [self.counts[dev] for dev in self.IDS if dev in self.counts]
+            self.done = bool(seen) and min(seen) >= 2
+        return self.done
+
+    def ids(self):
+        """The emulatable device IDs the controller addressed."""
+        return [dev for dev in self.IDS if dev in self.counts]
+
+def loadDetected(path):
+    """Device IDs saved by the last auto-detection, or None."""
+    if not path:
+        return None
+    try:
+        with open(path) as f:
+            ids = json.load(f)['ids']
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    ids = [dev for dev in ids if dev in Detector.IDS]
+    return ids or None
+
+def saveDetected(path, ids):
+    """Remember detected device IDs for the next start."""
+    if not path:
+        return
+    try:
+        with open(path + ".tmp", "w") as f:
+            json.dump({'ids': ids}, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print("WARNING: Unable to save detected devices to %s: %s" % (path, e))
+
+def createEmulators(args, interface=None):
+    """Build the registry of screen and spa emulators requested in args,
+    numbered up from the first remote and SpaLink address, and have the
+    interface build their ACK frames now rather than on the first poll."""
+    if (not args.spalink) and (not args.aqualink) and (not args.pda):
+        print("ERROR: Please specify one or more interfaces to emulate.")
+        sys.exit(-1)
+    registry = DeviceRegistry()
+    if args.aqualink:
+        for n in range(int(args.aqualink)):
+            print("Creating screen emulator at %02x..." % (Screen.ID + n))
+            registry.add(Screen(Screen.ID + n))
+    elif args.pda:
+        print("Creating PDA emulator...")
+        registry.add(PDA())
+    for n in range(int(args.spalink)):
+        print("Creating spa emulator at %02x..." % (Spa.ID + n))
+        registry.add(Spa(Spa.ID + n))
+    if interface is not None:
+        for dev in registry.devices.values():
+            interface.prepareAck(dev.ACK)
+    return registry
+
+def replay(args):
+    """Push a capture file through readMsg and the emulators, then report
+    the decode rate and how long each processMessage took."""
+    global ackGuard
+    port = ReplayPort(args.replay, args.speed)
+    if args.speed != 1.0:
+        ackGuard = 0  # No real master to keep pace with
+    i = Interface("Replay", port=port)
+
+    if (not args.spalink) and (not args.aqualink) and (not args.pda):
+        print("Detecting emulation settings from the capture...")
+        decoder = FrameDecoder()
+        for _, data in port.records:
+            for ret in decoder.feed(data):
+                detectDevice(ret, args)
+        if args.pda:
+            args.aqualink = 0
+    registry = createEmulators(args, i)
+    stats = {dev.ID: [0, 0.0, 0.0] for dev in registry.devices.values()}
+
+    print("Replaying %d records..." % len(port.records))
+    frames = 0
+    start = time.perf_counter()
+    while True:
+        ret = i.readMsg()
+        if 'stop' in ret:
+            break
+        frames += 1
+        t0 = time.perf_counter()
+        dev = registry.dispatch(ret, i)
+        if dev is not None:
+            took = time.perf_counter() - t0
+            stat = stats[dev.ID]
+            stat[0] += 1
+            stat[1] += took
+            stat[2] = max(stat[2], took)
+    elapsed = time.perf_counter() - start
+
+    print("Frames          : %d (%d bad checksum) in %.3f s, %.0f frames/s" %
+          (frames, i.decoder.badFrames, elapsed, frames / elapsed if elapsed else 0))
+    print("Bytes written   : %d" % port.written)
+    for devId, (count, total, worst) in sorted(stats.items()):
+        mean = total / count if count else 0
+        name = "%s.%02x" % (type(registry.devices[devId]).__name__, devId)
+        print("%-16s: %6d calls  %8.1f us mean  %8.1f us max  %6.3f s total" %
+              (name, count, mean * 1e6, worst * 1e6, total))
+
+def busLoop(i, registry, args, recheck=None, cached=None, link=None):
+    """Read frames and hand each to the device it is for until told to
+    stop, watching for the controller polling different devices than the
+    cached detection.  With --split the link passes on what changed."""
+    while True:
+        ret = i.readMsg()
+        if 'stop' in ret:
+            return
+        if (recheck is not None) and recheck.feed(ret, time.monotonic()):
+            if recheck.ids() != cached:
+                print("Controller now addresses %s, not the cached %s, restart to pick this up" %
+                      (toHex(recheck.ids()), toHex(cached)))
+                if recheck.ids():
+                    saveDetected(args.detectCache, recheck.ids())
+            recheck = None
+        dev = registry.dispatch(ret, i)
+        if link is not None:
+            link.afterFrame(i, registry, dev)
+
+def busProcess(args, i, registry, link, recheck, cached):
+    """With --split, the bus loop's own process.  The history and event log
+    live in the web process, so records are passed over the link."""
+    global history, events
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.prctl(1, signal.SIGINT)  # PR_SET_PDEATHSIG, don't outlive the web process
+    except (OSError, AttributeError, TypeError):
+        pass
+    if args.realtime:
+        raisePriority(args.realtime)
+    history = LinkFeed(link, events.enabled)
+    events = history
+    if trace.printer is not None:  # The printing thread stayed behind in the parent
+        trace.printer = None
+        trace.start()
+    for dev in registry.devices.values():
+        link.publish(dev)
+    i.waiting = lambda: link.idle(i, registry)
+    print("Main loop begins...")
+    busLoop(i, registry, args, recheck, cached, link)
+    i.stopCapture()
+
+
 def main():
     """Run as a standalone application"""
     args = parseArgs()
-    global RS485Device
+    if args.replay is not None:
+        replay(args)
+        return
+    global RS485Device, debugData, debugRaw
     RS485Device = args.device
+    debugData = debugData or args.debug
+    debugRaw = debugRaw or args.debugRaw
+    if debugData or debugRaw:
+        trace.start()
     print("Creating RS485 port...")
     i = Interface("RS485")
-
-    if (not args.spalink) and (not args.aqualink) and (not args.pda):
-        print("Attempting to auto-detect emulation settings, wait 15 seconds...")
-        endTime = time.time() + 15
-        while time.time() < endTime:
-            ret = i.readMsg()
-            if (ret['dest'] == Screen.ID) and (not args.aqualink):
-                print("...Detected old-style Aqualink pad.")
-                args.aqualink = True
-            if (ret['dest'] == PDA.ID) and (not args.pda):
-                print("...Detected new-style Aqualink PDA.")
-                args.pda = True
-            if (ret['dest'] == Spa.ID) and (not args.spalink):
-                print("...Detected SpaLink controller.")
-                args.spalink = True
+    if args.record is not None:
+        i.startCapture(args.record)
+    if args.eventLog is not None:
+        global events
+        events = EventLog(args.eventLog)
+
+    cached = None
+    recheck = None
+    if args.sniff:
+        print("Sniffing only, nothing will be sent on the bus...")
+    elif (not args.spalink) and (not args.aqualink) and (not args.pda):
+        cached = loadDetected(args.detectCache)
+        if cached is not None:
+            print("Using cached detection %s, re-checking in the background..." % toHex(cached))
+            recheck = Detector()
+            found = cached
+        else:
+            print("Attempting to auto-detect emulation settings, up to %d seconds..." % DETECTTIME)
+            detector = Detector()
+            while True:
+                ret = i.readMsg()
+                if 'stop' in ret:
+                    i.stopCapture()
+                    return
+                if detector.feed(ret, time.monotonic()):
+                    break
+            found = detector.ids()
+        for dev in found:
+            detectDevice({'dest': dev}, args)
         if args.pda:
-            args.aqualink = False
-        print("Detection completed...")
-
-    # Start the listener for a screen and spa, run webserver
-    if args.aqualink:
-        print("Creating screen emulator...")
-        screen = Screen()
-    elif args.pda:
-        print("Creating PDA emulator...")
-        screen = PDA()
-    if args.spalink:
-        print("Creating spa emulator...")
-        spa = Spa()
+            args.aqualink = 0
+        if cached is None:
+            if found:
+                saveDetected(args.detectCache, found)
+            print("Detection completed in %.1f s..." % (time.monotonic() - detector.start))
+
+    # Start the listeners for the screens and spas, run webserver
+    registry = DeviceRegistry() if args.sniff else createEmulators(args, i)
+    screen = registry.first(Screen)
+    spa = registry.first(Spa)
+
+    link = None
+    if args.split:
+        link = BusLink(registry.devices)
+        sys.stdout.flush()  # Nothing buffered before the fork may be written twice
+        if i.capture is not None:
+            i.capture.file.flush()
+        bus = multiprocessing.get_context("fork").Process(
+            target=busProcess, name="aquaweb-bus", daemon=True,
+            args=(args, i, registry, link, recheck, cached))
+        bus.start()
+        print("Bus loop running in process %d..." % bus.pid)
+        if i.port is not None:
+            i.port.close()  # The bus process has its own descriptor
+        webInterface = BusMirror()
+        for dev in registry.devices.values():
+            dev.keys = RemoteKeys(link, dev.ID)
+        threading.Thread(target=link.reader, args=(registry, webInterface, bus.is_alive),
+                         name="buslink", daemon=True).start()
+        webHandler.link = link
     else:
-        spa = None
-    if (not args.spalink) and (not args.aqualink) and (not args.pda):
-        print("ERROR: Please specify one or more interfaces to emulate.")
-        sys.exit(-1)
+        webInterface = i
 
     print("Creating web server on port %d ..." % args.port)
-    server = threading.Thread(target=startServer, args=(screen, spa, args.port))
+    MyServer.workers = args.httpWorkers
+    MyServer.websockets = args.websockets
+    global ASSETDIR
+    ASSETDIR = args.assets
+    webHandler.timeout = args.httpIdle
+    server = threading.Thread(target=startServer,
+                              args=(screen, spa, args.port, webInterface, registry.devices))
     server.start()
 
-    print("Main loop begins...")
-    while True:
-        ret = i.readMsg()
-        if 'stop' in ret:
-            global webServer
-            webServer.shutdown()
-            return
-        if args.aqualink or args.pda:
-            if ret['dest'] == screen.ID:
-                screen.processMessage(ret, i)
-        if args.spalink:
-            if ret['dest'] == spa.ID:
-                spa.processMessage(ret, i)
+    if link is not None:
+        try:
+            bus.join()
+            print("Bus process exited with code %s" % bus.exitcode)
+        except KeyboardInterrupt:
+            print("Keyboard exit requested.")
+            if bus.is_alive():
+                os.kill(bus.pid, signal.SIGINT)  # Let it close the capture file
+            bus.join(5)
+            if bus.is_alive():
+                bus.terminate()
+        link.close()
+    else:
+        print("Main loop begins...")
+        busLoop(i, registry, args, recheck, cached)
+        i.stopCapture()
+    global webServer
+    events.close()
+    webServer.shutdown()
+    webServer.server_close()
 
 if __name__ == "__main__":
     main()
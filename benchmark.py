@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""benchmark.py - Throughput benchmarks for the aquaweb RS485 hot paths"""
+
+# Copyright (c) 2023, Earle F. Philhower, III <earlephilhower@yahoo.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import http.client
+import itertools
+import json
+import multiprocessing
+import sys
+import threading
+import time
+
+import aquaweb
+from aquaweb import DLE, STX, ETX, NUL
+
+
+def buildFrame(dest, cmd, args, badChecksum=False):
+    """Build a DLE-stuffed wire frame the way the Jandy master would."""
+    body = [DLE, STX, dest, cmd] + list(args)
+    check = sum(body) & 255
+    if badChecksum:
+        check = (check + 1) & 255
+    out = [DLE, STX]
+    for byte in body[2:] + [check]:
+        out.append(byte)
+        if byte == DLE:
+            out.append(NUL)
+    return bytes(out + [DLE, ETX])
+
+
+def sampleTraffic(count):
+    """A mix of probes, screen writes, DLE-heavy payloads, SpaLink traffic
+    and the odd corrupted frame, roughly what a busy bus looks like."""
+    frames = [
+        buildFrame(0x40, 0x00, []),
+        buildFrame(0x40, 0x04, [3] + list(b"AIR TEMP   78`F") + [0]),
+        buildFrame(0x40, 0x0f, [1, 11, 255]),
+        buildFrame(0x40, 0x10, [4, 0, 15]),
+        buildFrame(0x20, 0x03, [0x20, 0x37, 0x38, 0x20, 0x00, 0x00, 0x00, 0x21, 0x00, 0x00]),
+        buildFrame(0x20, 0x02, [0x11, 0x00]),
+        buildFrame(0x41, 0x04, [0x10] * 16 + [0]),
+        buildFrame(0x60, 0x04, [0x82] + list(b"POOL  80`F") + [0], badChecksum=True),
+        buildFrame(0x00, 0x01, [0x8b, 0x00]),
+    ]
+    out = bytearray()
+    n = 0
+    while n < count:
+        frame = frames[n % len(frames)]
+        out += frame
+        if n % 5 == 0:
+            out += b"\x00\x00"  # Inter-frame idle NULs
+        n += 1
+    return bytes(out)
+
+
+class BufferPort:
+    """Minimal serial port stand-in that plays back a byte buffer, handing
+    out at most `burst` bytes per read like a UART FIFO would."""
+
+    def __init__(self, data, burst=64):
+        self.data = data
+        self.pos = 0
+        self.burst = burst
+
+    @property
+    def in_waiting(self):
+        return min(self.burst, len(self.data) - self.pos)
+
+    def read(self, size=1):
+        if self.pos >= len(self.data):
+            raise EOFError  # Ends the benchmark run cleanly
+        ret = self.data[self.pos:self.pos + size]
+        self.pos += len(ret)
+        return ret
+
+    def write(self, data):
+        return len(data)
+
+
+def legacyReadMsg(port, state):
+    """The original byte-at-a-time readMsg framing, kept for comparison."""
+    msg = state['msg']
+    while True:
+        dleFound = False
+        try:
+            msg += port.read(2)
+        except EOFError:
+            return {'stop': '1'}
+        while len(msg) < 2:
+            msg += [0x00]
+        while (msg[-1] != ETX) or (not dleFound) or (len(msg) > 128):
+            try:
+                msg += port.read(1)
+            except EOFError:
+                return {'stop': '1'}
+            if msg[-1] == DLE:
+                dleFound = True
+            if (msg[-2] == DLE) and (msg[-1] == NUL) and dleFound:
+                msg = msg[:-1]
+                dleFound = False
+        while msg[0] == 0x00:
+            msg = msg[1:]
+        dlestx = msg[0:2]
+        dest = msg[2:3]
+        cmd = msg[3:4]
+        args = msg[4:-3]
+        checksum = msg[-3:-2]
+        msg = []
+        state['msg'] = msg
+        if (sum(dlestx + dest + cmd + args) & 255) == checksum[0]:
+            return {'dest': dest[0], 'cmd': cmd[0], 'args': args}
+        return {'dest': 0xff, 'cmd': 0xff, 'args': []}
+
+
+def runLegacy(data):
+    """Decode the whole buffer with the legacy parser, return frame count."""
+    port = BufferPort(data)
+    state = {'msg': []}
+    frames = 0
+    while 'stop' not in legacyReadMsg(port, state):
+        frames += 1
+    return frames
+
+
+def runDecoder(data):
+    """Decode the whole buffer through Interface.readMsg, return frame count."""
+    i = aquaweb.Interface("bench", port=BufferPort(data))
+    frames = 0
+    while 'stop' not in i.readMsg():
+        frames += 1
+    return frames
+
+
+def timeit(func, data, repeat):
+    """Best-of-N wall time for func(data)."""
+    best = None
+    frames = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        frames = func(data)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return frames, best
+
+
+def benchDecoder(args):
+    """Compare the legacy framing against the chunked FrameDecoder."""
+    data = sampleTraffic(args.frames)
+    print("Decoding %d frames (%d bytes), best of %d" % (args.frames, len(data), args.repeat))
+    results = {}
+    for name, func in (("legacy readMsg", runLegacy), ("FrameDecoder", runDecoder)):
+        frames, elapsed = timeit(func, data, args.repeat)
+        results[name] = elapsed
+        print("%-16s: %7d frames  %8.3f s  %10.0f frames/s  %8.0f KB/s" %
+              (name, frames, elapsed, frames / elapsed, len(data) / elapsed / 1024))
+    print("Speedup         : %.1fx" % (results["legacy readMsg"] / results["FrameDecoder"]))
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    idx = min(len(samples) - 1, int(round(pct / 100.0 * (len(samples) - 1))))
+    return samples[idx]
+
+
+def measure(func, samples, batch):
+    """Time `samples` batches of `batch` calls to func, returning the sorted
+    per-call latencies in seconds.  Batching keeps timer overhead out of
+    the very cheap operations."""
+    func()  # Warm up
+    lat = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        for _ in range(batch):
+            func()
+        lat.append((time.perf_counter() - start) / batch)
+    lat.sort()
+    return lat
+
+
+def alternate(func, payloads):
+    """Call func with each payload in turn.  The devices skip redraws that
+    change nothing and cache their renders, so replaying one payload would
+    only time those shortcuts."""
+    cycle = itertools.cycle(payloads)
+    return lambda: func(next(cycle))
+
+
+def microBenchmarks(samples, batch):
+    """Build the stage-by-stage benchmarks as (name, callable) pairs."""
+    aquaweb.ackGuard = 0  # Don't sleep waiting on a master that isn't there
+    traffic = sampleTraffic(samples * batch + 100)
+    rx = aquaweb.Interface("bench", port=BufferPort(traffic))
+    tx = aquaweb.Interface("bench", port=BufferPort(b""))
+    screen = aquaweb.Screen()
+    spa = aquaweb.Spa()
+
+    line = [3] + list(b"AIR TEMP   78`F") + [0]
+    dleLine = [5] + [DLE] * 8 + list(b"POOL ON") + [0]
+    writelines = [{'dest': screen.ID, 'cmd': 0x04, 'args': [row] + list(text) + [0]}
+                  for row, text in ((3, b"AIR TEMP   78`F"), (4, b"POOL TEMP  80`F"),
+                                    (3, b"AIR TEMP   79`F"), (4, b"POOL TEMP  81`F"))]
+    scrolls = [{'dest': screen.ID, 'cmd': 0x0f, 'args': [1, 11, direction]}
+               for direction in (255, 1)]
+    inverts = [{'dest': screen.ID, 'cmd': 0x10, 'args': args}
+               for args in ([4, 0, 15], [5, 2, 9])]
+    spaTexts = [[0x20, 0x37, digit, 0x20, 0x00, 0x00, 0x00, 0x21, 0x00, 0x00]
+                for digit in (0x38, 0x39)]
+    checksumMsg = [DLE, STX, 0x40, 0x04] + line
+
+    # Put something worth rendering on the screen
+    for row in range(screen.H):
+        screen.writeLine(row, "LINE %d TEXT" % row)
+    screen.invertChars(4, 0, 15)
+    spa.update(spaTexts[0])
+
+    fills = itertools.cycle(["SCROLLED IN %d" % n for n in range(3)])
+    def scroll(msg):
+        # Refill the ends a scroll blanks, without publishing, so the
+        # screen never settles to all blank lines
+        screen.screen[1] = screen.screen[11] = next(fills)
+        screen.processMessage(msg, tx)
+
+    def screenHtml(args):
+        screen.invertChars(*args)
+        return screen.html()
+
+    def spaHtml(args):
+        spa.update(args)
+        return spa.html()
+
+    return [
+        ("Interface.readMsg", rx.readMsg),
+        ("Interface.checksum", lambda: tx.checksum(checksumMsg)),
+        ("Interface.sendMsg", lambda: tx.sendMsg(0x00, 0x01, dleLine)),
+        ("Interface.sendAck", lambda: tx.sendAck(screen.ACK, 0x10)),
+        ("Screen.process.04", alternate(lambda msg: screen.processMessage(msg, tx), writelines)),
+        ("Screen.process.0f", alternate(scroll, scrolls)),
+        ("Screen.process.10", alternate(lambda msg: screen.processMessage(msg, tx), inverts)),
+        ("Screen.html", alternate(screenHtml, [msg['args'] for msg in inverts])),
+        ("Spa.update", alternate(spa.update, spaTexts)),
+        ("Spa.html", alternate(spaHtml, spaTexts)),
+    ]
+
+
+def benchMicro(args):
+    """Run each hot-path stage on its own and report ops/sec and latency
+    percentiles, optionally saving or checking against a JSON baseline."""
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print("Micro benchmarks: %d samples x %d calls" % (args.samples, args.batch))
+    print("%-20s %12s %9s %9s %9s %9s" % ("stage", "ops/s", "p50 us", "p90 us", "p99 us", "vs base"))
+    results = {}
+    regressions = []
+    for name, func in microBenchmarks(args.samples, args.batch):
+        if args.only and args.only not in name:
+            continue
+        lat = measure(func, args.samples, args.batch)
+        p50 = percentile(lat, 50)
+        results[name] = {'ops': 1.0 / (sum(lat) / len(lat)), 'p50': p50,
+                         'p90': percentile(lat, 90), 'p99': percentile(lat, 99)}
+        change = ""
+        if name in baseline:
+            ratio = p50 / baseline[name]['p50']
+            change = "%+8.1f%%" % ((ratio - 1) * 100)
+            if ratio > 1 + args.threshold / 100.0:
+                change += " SLOWER"
+                regressions.append(name)
+        r = results[name]
+        print("%-20s %12.0f %9.2f %9.2f %9.2f %s" %
+              (name, r['ops'], r['p50'] * 1e6, r['p90'] * 1e6, r['p99'] * 1e6, change))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Saved baseline to " + args.save)
+    if regressions:
+        print("REGRESSION (> %.0f%% slower p50): %s" % (args.threshold, ", ".join(regressions)))
+    return not regressions
+
+
+def hammer(port, paths, stop, served):
+    """Web client run in its own process: fetch paths round robin over a
+    keep-alive connection until told to stop."""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    n = 0
+    while not stop.is_set():
+        conn.request("GET", paths[n % len(paths)])
+        conn.getresponse().read()
+        n += 1
+    conn.close()
+    with served.get_lock():
+        served.value += n
+
+
+def busRun(screen, spa, tx, seconds):
+    """Drive processMessage as the bus thread would, with the screen and spa
+    changing on every frame, and return the sorted per-frame latencies."""
+    frames = []
+    for n in range(12):
+        frames.append((screen, {'dest': screen.ID, 'cmd': 0x04,
+                                'args': [n] + list(("LINE %d %d" % (n, n * 7)).encode()) + [0]}))
+        frames.append((screen, {'dest': screen.ID, 'cmd': 0x10, 'args': [n, 0, n]}))
+    frames.append((screen, {'dest': screen.ID, 'cmd': 0x0f, 'args': [1, 11, 255]}))
+    frames.append((spa, {'dest': spa.ID, 'cmd': 0x03,
+                         'args': [0x20, 0x37, 0x38, 0x20, 0x00, 0x00, 0x00, 0x21, 0x00, 0x00]}))
+    frames.append((spa, {'dest': spa.ID, 'cmd': 0x03,
+                         'args': [0x20, 0x31, 0x30, 0x32, 0x00, 0x00, 0x00, 0x21, 0x00, 0x00]}))
+    lat = []
+    end = time.perf_counter() + seconds
+    n = 0
+    while time.perf_counter() < end:
+        dev, ret = frames[n % len(frames)]
+        start = time.perf_counter()
+        dev.processMessage(ret, tx)
+        lat.append(time.perf_counter() - start)
+        n += 1
+        time.sleep(0.0005)  # Bus pacing, lets the web threads run
+    lat.sort()
+    return lat
+
+
+def benchStress(args):
+    """Measure bus-side processMessage latency idle and while client
+    processes hammer the web server, which only reads published snapshots."""
+    aquaweb.ackGuard = 0
+    tx = aquaweb.Interface("bench", port=BufferPort(b""))
+    screen = aquaweb.Screen()
+    spa = aquaweb.Spa()
+    server = threading.Thread(target=aquaweb.startServer,
+                              args=(screen, spa, args.stressPort, tx), daemon=True)
+    server.start()
+    time.sleep(0.5)
+    paths = ["/cgi/screen.cgi", "/cgi/screen.cgi?since=", "/api/state",
+             "/cgi/spascreen.cgi", "/cgi/spastatus.cgi"]
+
+    print("Stress: bus latency with 0 and %d web clients, %.0f s each" %
+          (args.clients, args.seconds))
+    print("%-20s %9s %9s %9s %9s %10s" % ("web clients", "p50 us", "p90 us", "p99 us", "max us", "requests"))
+    for clients in (0, args.clients):
+        stop = multiprocessing.Event()
+        served = multiprocessing.Value('l', 0)
+        procs = [multiprocessing.Process(target=hammer, args=(args.stressPort, paths, stop, served))
+                 for _ in range(clients)]
+        for p in procs:
+            p.start()
+        time.sleep(0.5 if clients else 0)
+        lat = busRun(screen, spa, tx, args.seconds)
+        stop.set()
+        for p in procs:
+            p.join()
+        print("%-20d %9.1f %9.1f %9.1f %9.1f %10d" %
+              (clients, percentile(lat, 50) * 1e6, percentile(lat, 90) * 1e6,
+               percentile(lat, 99) * 1e6, lat[-1] * 1e6, served.value))
+    aquaweb.webServer.shutdown()
+    aquaweb.webServer.server_close()
+
+
+def parseArgs():
+    """Scan the arguments from the command line and/or print help message."""
+    parser = argparse.ArgumentParser(description="Benchmark the aquaweb RS485 hot paths.")
+    parser.add_argument("suite", nargs="?", choices=["all", "micro", "decoder", "stress"], default="all",
+                        help="Which benchmarks to run, default=all")
+    parser.add_argument("--frames", "-f", dest="frames", type=int, default=20000,
+                        help="Number of frames to push through each parser, default=20000")
+    parser.add_argument("--repeat", "-r", dest="repeat", type=int, default=3,
+                        help="Runs per benchmark, best time is reported, default=3")
+    parser.add_argument("--samples", dest="samples", type=int, default=200,
+                        help="Timed samples per micro benchmark, default=200")
+    parser.add_argument("--batch", dest="batch", type=int, default=50,
+                        help="Calls per timed sample, default=50")
+    parser.add_argument("--only", dest="only", default=None,
+                        help="Only run micro benchmarks whose name contains this string")
+    parser.add_argument("--save", dest="save", default=None,
+                        help="Save the micro benchmark results as a JSON baseline")
+    parser.add_argument("--baseline", dest="baseline", default=None,
+                        help="Compare the micro benchmark results against a JSON baseline")
+    parser.add_argument("--threshold", dest="threshold", type=float, default=10.0,
+                        help="Percent p50 slowdown vs. the baseline flagged as a regression, "
+                             "default=10")
+    parser.add_argument("--clients", dest="clients", type=int, default=4,
+                        help="Web client processes for the stress test, default=4")
+    parser.add_argument("--seconds", dest="seconds", type=float, default=3.0,
+                        help="Seconds per stress test phase, default=3")
+    parser.add_argument("--stress-port", dest="stressPort", type=int, default=18480,
+                        help="Local port for the stress test web server, default=18480")
+    return parser.parse_args()
+
+
+def main():
+    """Run as a standalone application"""
+    args = parseArgs()
+    ok = True
+    if args.suite in ("all", "decoder"):
+        benchDecoder(args)
+    if args.suite == "all":
+        print()
+    if args.suite in ("all", "micro"):
+        ok = benchMicro(args)
+    if args.suite == "all":
+        print()
+    if args.suite in ("all", "stress"):
+        benchStress(args)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""jandysim.py - Simulated Jandy master on a pseudo-terminal, for load and
+conformance testing of the aquaweb emulators without any pool equipment"""
+
+# Copyright (c) 2023, Earle F. Philhower, III <earlephilhower@yahoo.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import collections
+import os
+import pty
+import random
+import select
+import sys
+import threading
+import time
+import tty
+
+import aquaweb
+from aquaweb import DLE
+from benchmark import buildFrame, percentile
+
+
+class Master:
+    """The controller's end of the pty: writes frames and waits for ACKs."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.decoder = aquaweb.FrameDecoder()
+        self.pending = collections.deque()
+
+    def send(self, frame):
+        """Write a whole frame, returning the time its last byte went out."""
+        view = memoryview(frame)
+        while view:
+            view = view[os.write(self.fd, view):]
+        return time.perf_counter()
+
+    def waitAck(self, timeout):
+        """Next frame addressed to the master and its arrival time, or
+        (None, None) if nothing arrives within timeout seconds."""
+        end = time.perf_counter() + timeout
+        while not self.pending:
+            left = end - time.perf_counter()
+            if left <= 0:
+                return None, None
+            if not select.select([self.fd], [], [], left)[0]:
+                return None, None
+            data = os.read(self.fd, 4096)
+            now = time.perf_counter()
+            self.pending.extend((ret, now) for ret in self.decoder.feed(data)
+                                if ret['dest'] == 0x00)
+        return self.pending.popleft()
+
+    def drain(self):
+        """Throw away anything still unread, e.g. a late ACK."""
+        while select.select([self.fd], [], [], 0)[0]:
+            self.decoder.feed(os.read(self.fd, 4096))
+        self.pending.clear()
+
+
+def remoteTraffic(dest, rng):
+    """One frame of the kind the master sends a square remote or PDA."""
+    kind = rng.randrange(7)
+    if kind == 0:
+        return 0x00, []                              # Probe
+    if kind == 1:
+        return 0x09, [0]                             # CLS
+    if kind == 2:
+        text = "".join(rng.choice("ABCDEFGHIJ 0123456789`") for _ in range(16))
+        return 0x04, [rng.randrange(12)] + list(text.encode()) + [0]  # WRITELINE
+    if kind == 3:                                    # WRITELINE, DLE heavy
+        return 0x04, [rng.randrange(12)] + [DLE] * rng.randrange(4, 17) + [0]
+    if kind == 4:
+        return 0x0f, [1, 11, rng.choice((1, 255))]   # SCROLL
+    if kind == 5:
+        return 0x08, [rng.randrange(12)]             # INVERT line
+    return 0x10, [rng.randrange(12), 0, rng.randrange(1, 16)]  # INVERT chars
+
+
+def spaTraffic(dest, rng):
+    """One frame of the kind the master sends a SpaLink."""
+    if rng.randrange(2):
+        return 0x02, [rng.choice((0x00, 0x01, 0x08, 0x10, 0x19, DLE)), 0x00]
+    temp = str(rng.randrange(60, 105)).encode()
+    args = [0x20, temp[0], temp[1], 0x20, 0, 0, 0, 0, 0, 0]
+    where = rng.choice((5, 7, 9))  # SET, H2O or AIR
+    args[where] = 1 if where == 5 else 0x21
+    return 0x03, args
+
+
+def busLoop(i, registry):
+    """What aquaweb's main loop does: read, hand to the addressed device."""
+    while True:
+        ret = i.readMsg()
+        if 'stop' in ret:
+            return
+        registry.dispatch(ret, i)
+
+
+def simulate(args):
+    """Drive the emulators over a pty, return a list of failures."""
+    rng = random.Random(args.seed)
+    masterFd, slaveFd = pty.openpty()
+    tty.setraw(slaveFd)
+    aquaweb.RS485Device = os.ttyname(slaveFd)
+    if args.guard is not None:
+        aquaweb.ackGuard = args.guard
+    i = aquaweb.Interface("sim")
+    registry = aquaweb.createEmulators(argparse.Namespace(aqualink=args.remotes, pda=args.pda,
+                                                          spalink=args.spas), i)
+    bus = threading.Thread(target=busLoop, args=(i, registry), daemon=True)
+    bus.start()
+    master = Master(masterFd)
+
+    devices = [registry.devices[devId] for devId in sorted(registry.devices)]
+    expected = {dev.ID: collections.deque() for dev in devices}
+    latency = {dev.ID: [] for dev in devices}
+    failures = []
+    missed = 0
+    bad = 0
+    queued = 0
+    period = 1.0 / args.rate if args.rate else 0
+    nextSend = time.perf_counter()
+
+    def poll(dev, cmd, cargs, corrupt):
+        """Send one frame to dev and check the reply, if any is due."""
+        nonlocal missed, nextSend
+        if period:
+            delay = nextSend - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            nextSend = max(nextSend + period, time.perf_counter())
+        sent = master.send(buildFrame(dev.ID, cmd, cargs, corrupt))
+        ret, when = master.waitAck(args.badWait if corrupt else args.timeout)
+        if corrupt:
+            if ret is not None:
+                failures.append("%02x answered a frame with a bad checksum" % dev.ID)
+            return
+        if ret is None:
+            missed += 1
+            master.drain()
+            return
+        latency[dev.ID].append(when - sent)
+        if ret['cmd'] != 0x01 or len(ret['args']) != 2 or ret['args'][0] != dev.ACK:
+            failures.append("%02x sent a malformed ACK %s" % (dev.ID, aquaweb.toHex(ret['args'])))
+            return
+        key = ret['args'][1]
+        if key:
+            want = expected[dev.ID].popleft() if expected[dev.ID] else None
+            if key != want:
+                failures.append("%02x ACKed key %02x, expected %s" %
+                                (dev.ID, key, "none" if want is None else "%02x" % want))
+
+    start = time.perf_counter()
+    frames = 0
+    for n in range(args.frames):
+        if not bus.is_alive():
+            failures.append("the bus loop died after %d frames" % frames)
+            break
+        dev = devices[n % len(devices)]
+        if rng.random() < args.keyRate:
+            key = rng.choice(sorted(dev.KEYS))
+            if dev.sendKey(key):
+                expected[dev.ID].append(dev.KEYS[key])
+                queued += 1
+        corrupt = args.badEvery and (rng.randrange(args.badEvery) == 0)
+        bad += bool(corrupt)
+        traffic = spaTraffic if isinstance(dev, aquaweb.Spa) else remoteTraffic
+        poll(dev, *traffic(dev.ID, rng), corrupt)
+        frames += 1
+    elapsed = time.perf_counter() - start
+
+    # Keep probing until every queued key has come back
+    for _ in range(4 * aquaweb.KEYQUEUE):
+        waiting = [dev for dev in devices if expected[dev.ID]]
+        if (not waiting) or (not bus.is_alive()):
+            break
+        for dev in waiting:
+            poll(dev, 0x00, [], False)
+    for dev in devices:
+        if expected[dev.ID]:
+            failures.append("%02x never sent %d queued keys" % (dev.ID, len(expected[dev.ID])))
+
+    print("Frames          : %d to %d devices in %.2f s, %.0f frames/s, %d bad checksums" %
+          (frames, len(devices), elapsed, frames / elapsed, bad))
+    print("Keys            : %d queued, %d missed ACKs" % (queued, missed))
+    print("%-16s %9s %9s %9s %9s %9s" % ("ACK latency", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    everything = []
+    for dev in devices:
+        lat = sorted(latency[dev.ID])
+        everything += lat
+        if lat:
+            print("%-16s %9d %9.2f %9.2f %9.2f %9.2f" %
+                  ("%s.%02x" % (type(dev).__name__, dev.ID), len(lat), percentile(lat, 50) * 1e3,
+                   percentile(lat, 90) * 1e3, percentile(lat, 99) * 1e3, lat[-1] * 1e3))
+    everything.sort()
+    if everything:
+        p99 = percentile(everything, 99)
+        print("%-16s %9d %9.2f %9.2f %9.2f %9.2f" %
+              ("all", len(everything), percentile(everything, 50) * 1e3,
+               percentile(everything, 90) * 1e3, p99 * 1e3, everything[-1] * 1e3))
+        if p99 > args.deadline:
+            failures.append("p99 ACK latency %.2f ms over the %.2f ms deadline" %
+                            (p99 * 1e3, args.deadline * 1e3))
+    if missed:
+        failures.append("%d frames were never ACKed" % missed)
+    return failures
+
+
+def parseArgs():
+    """Scan the arguments from the command line and/or print help message."""
+    parser = argparse.ArgumentParser(description="Drive the aquaweb emulators from a simulated "
+                                                 "Jandy master over a pty and check their ACKs.")
+    parser.add_argument("--frames", "-f", dest="frames", type=int, default=5000,
+                        help="Frames to send, default=5000")
+    parser.add_argument("--rate", dest="rate", type=float, default=0,
+                        help="Frames per second, default=0 (as fast as the ACKs come back)")
+    parser.add_argument("--remotes", "-a", dest="remotes", type=int, default=1,
+                        help="Square remotes to emulate from 0x40, default=1")
+    parser.add_argument("--pda", "-p", dest="pda", action='store_true', default=False,
+                        help="Emulate a PDA at 0x60 instead of square remotes")
+    parser.add_argument("--spas", "-s", dest="spas", type=int, default=1,
+                        help="SpaLinks to emulate from 0x20, default=1")
+    parser.add_argument("--bad-every", dest="badEvery", type=int, default=50,
+                        help="Corrupt the checksum of about one frame in this many, 0=never, "
+                             "default=50")
+    parser.add_argument("--key-rate", dest="keyRate", type=float, default=0.05,
+                        help="Chance of queueing a keypress before each frame, default=0.05")
+    parser.add_argument("--timeout", dest="timeout", type=float, default=0.1,
+                        help="Seconds to wait for an ACK before counting it missed, default=0.1")
+    parser.add_argument("--bad-wait", dest="badWait", type=float, default=0.02,
+                        help="Seconds to check a corrupted frame goes unanswered, default=0.02")
+    parser.add_argument("--deadline", dest="deadline", type=float, default=0.010,
+                        help="Longest acceptable p99 ACK latency in seconds, default=0.010")
+    parser.add_argument("--guard", dest="guard", type=float, default=None,
+                        help="Override the turnaround guard in seconds, e.g. 0 to measure "
+                             "raw processing time")
+    parser.add_argument("--seed", dest="seed", type=int, default=1,
+                        help="Random seed for the traffic mix, default=1")
+    args = parser.parse_args()
+    if args.frames < 1:
+        parser.error("--frames must be at least 1")
+    if args.pda:
+        args.remotes = 0
+    return args
+
+
+def main():
+    """Run as a standalone application"""
+    args = parseArgs()
+    failures = simulate(args)
+    for failure in failures[:20]:
+        print("FAIL: " + failure)
+    if len(failures) > 20:
+        print("FAIL: ... and %d more" % (len(failures) - 20))
+    print("PASS" if not failures else "FAIL")
+    sys.exit(0 if not failures else 1)
+
+
+if __name__ == "__main__":
+    main()